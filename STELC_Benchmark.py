@@ -0,0 +1,101 @@
+#!/usr/bin/python
+"""
+Throughput benchmark of STELC_Recorder.Record over Record.chunk sizes,
+using the simulated inputs from STELC_Simulator instead of a device.
+For each chunk size BENCH_SECONDS of audio are recorded to a scratch
+directory and reported are
+  jitter: mean and worst difference between callback intervals and the
+          buffer period (real time or faster runs only)
+  callback: worst time spent in the callback
+  overflows: Input Overflows flagged by the simulated device
+  writer lag: deepest the ring buffer got, in seconds of audio
+  drops: buffers dropped because the ring buffer was full
+  cpu/hour: CPU seconds used per hour of audio recorded
+usage: STELC_Benchmark.py [seconds [speed [wav file]]]
+  speed is times faster than real time, 0 for as fast as possible
+  without a wav file a synthetic sine wave is recorded
+"""
+import os,sys,time
+import tempfile,shutil
+import STELC_Recorder as sR
+import STELC_Simulator as sM
+
+DEBUG = 0
+CHUNKS = [1024,2048,4096,8192,16384,65536]
+BENCH_SECONDS = 60
+BENCH_SPEED = 1.0
+
+def benchmark(chunk,source,seconds,directory):
+  """
+  record seconds from source with chunk frames per buffer
+  and return a dictionary of the results
+  """
+  r = sR.Record(recordSeconds=seconds,
+                waveFilename=os.path.join(directory,'bench_%d.wav' % chunk),
+                source=source,chunk=chunk)
+  stream = r.stream
+  cpuStart = os.times()
+  r.start()
+  while stream.is_active():
+    time.sleep(0.1)
+  r.stop()
+  cpuEnd = os.times()
+  stats = r.bufferStats()
+  bytesPerSecond = r.inputChannels*r.sampleSize*r.samplingRate
+  del r
+  recorded = float(stats['bytesWritten'])/bytesPerSecond
+  result = {'chunk': chunk,
+            'recorded': recorded,
+            'overflows': stream.overflows,
+            'lag': float(stats['highWater'])/bytesPerSecond,
+            'drops': stats['droppedBuffers'],
+            'callback': max(stream.callDurations or [0.]),
+            'jitter': None,
+            'jitterMax': None,
+            'cpu': 0.}
+  if recorded:
+    cpu = (cpuEnd[0] + cpuEnd[1]) - (cpuStart[0] + cpuStart[1])
+    result['cpu'] = cpu/recorded*3600.
+  if stream.speed and len(stream.callTimes) > 1:
+    period = float(chunk)/stream.rate/stream.speed
+    deviations = [abs(b - a - period) for (a,b) in
+                  zip(stream.callTimes[:-1],stream.callTimes[1:])]
+    result['jitter'] = sum(deviations)/len(deviations)
+    result['jitterMax'] = max(deviations)
+  return result
+
+def makeSource(filename,speed):
+  if filename: return sM.FileSource(filename,speed=speed,loop=True)
+  return sM.SyntheticSource('sine',speed=speed)
+
+def formatMs(seconds):
+  if seconds is None: return '%8s' % '-'
+  return '%8.2f' % (1000.*seconds)
+
+def main(argv):
+  seconds = BENCH_SECONDS
+  speed = BENCH_SPEED
+  filename = None
+  if len(argv) > 1: seconds = float(argv[1])
+  if len(argv) > 2: speed = float(argv[2])
+  if len(argv) > 3: filename = argv[3]
+  directory = tempfile.mkdtemp(prefix='STELC_bench_')
+  print "%d seconds per chunk size at %s, %s" % (
+    seconds,speed and '%sx' % speed or 'max speed',filename or 'synthetic sine')
+  print "%7s %8s %8s %8s %9s %8s %6s %9s" % ('chunk','jit ms','jmax ms',
+    'cb ms','overflows','lag s','drops','cpu s/hr')
+  try:
+    for chunk in CHUNKS:
+      source = makeSource(filename,speed)
+      result = benchmark(chunk,source,seconds,directory)
+      source.terminate()
+      print "%7d %s %s %s %9d %8.2f %6d %9.1f" % (chunk,
+        formatMs(result['jitter']),formatMs(result['jitterMax']),
+        formatMs(result['callback']),result['overflows'],result['lag'],
+        result['drops'],result['cpu'])
+      sys.stdout.flush()
+  finally:
+    shutil.rmtree(directory)
+
+if __name__ == '__main__':
+  main(sys.argv)
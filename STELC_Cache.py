@@ -0,0 +1,159 @@
+#!/usr/bin/python
+"""
+used by STELC_pi to remember what has been converted and uploaded so a
+file is not converted or uploaded again after a crash or an update.
+Entries are keyed by a SHA-1 of the content and the settings used, for
+a wav file only its audio data and format are hashed so a repaired
+header does not count as a change.  The hash of a wav worked out while
+it was recorded (see STELC_Recorder.readHash) is used when there is one,
+so the file is not read again just for that.  Hashes are kept with each
+file's size and modification time and only worked out again when those
+change.
+The cache is kept in CACHE_FILENAME, Cache objects in different threads
+share it by reading it again before each change.
+"""
+import os,sys,time
+import hashlib
+import threading
+import yaml
+import STELC_Recorder as sR
+import STELC_Converter as sV
+
+DEBUG = 1
+CACHE_FILENAME = 'STELC_cache.yaml'
+# bytes hashed at a time
+READ_BYTES = 1024*1024
+
+# the cache file is changed by one thread at a time
+cacheLock = threading.Lock()
+
+def fileHash(filename):
+  """
+  SHA-1 of the audio of a wav file, or of all of any other file
+  """
+  sha1 = hashlib.sha1()
+  f = open(filename,'rb')
+  try:
+    try:
+      (channels,sampleWidth,rate,dataOffset,left) = sV.readHeader(f)
+      sha1 = sR.audioHash(channels,sampleWidth,rate)
+      f.seek(dataOffset)
+    except (sV.ConvertError,IOError):
+      f.seek(0)
+      left = None
+    while left is None or left > 0:
+      data = f.read(left is None and READ_BYTES or min(left,READ_BYTES))
+      if not data: break
+      sha1.update(data)
+      if left is not None: left -= len(data)
+  finally:
+    f.close()
+  return sha1.hexdigest()
+
+def fileStamp(filename):
+  s = os.stat(filename)
+  return [s.st_size,int(s.st_mtime)]
+
+class Cache():
+  """
+  The converted files and uploads done, keyed by key()
+  """
+  def __init__(self):
+    self.cache = {}
+    self.load()
+
+  def load(self):
+    self.cache = {}
+    if os.path.exists(CACHE_FILENAME):
+      try:
+        f = open(CACHE_FILENAME)
+        self.cache = yaml.safe_load(f) or {}
+        f.close()
+      except (IOError,yaml.YAMLError),e:
+        if DEBUG: print "could not read %s: %s" % (CACHE_FILENAME,e)
+    for section in ('hashes','converted','uploaded'):
+      self.cache.setdefault(section,{})
+
+  def put(self,section,key,value):
+    """
+    set key of section, merged with what other threads have put
+    """
+    cacheLock.acquire()
+    try:
+      self.load()
+      self.cache[section][key] = value
+      tmpFilename = CACHE_FILENAME + '.tmp'
+      f = open(tmpFilename,'w')
+      yaml.safe_dump(self.cache,f,default_flow_style=False)
+      f.close()
+      os.rename(tmpFilename,CACHE_FILENAME)
+    finally:
+      cacheLock.release()
+
+  def hash(self,filename):
+    """
+    the content hash of filename, worked out only if it changed
+    """
+    stamp = fileStamp(filename)
+    known = self.cache['hashes'].get(filename)
+    if known and known[:2] == stamp: return known[2]
+    digest = sR.readHash(filename)
+    if not digest:
+      # not recorded by a SafeWave, or changed since
+      started = time.time()
+      digest = fileHash(filename)
+      if DEBUG: print "hashed %s in %.1fs" % (filename,time.time() - started)
+    self.put('hashes',filename,stamp + [digest])
+    return digest
+
+  def key(self,filename,settings):
+    """
+    the key for the content of filename with settings (a dictionary),
+    None if the file can not be read
+    """
+    # pick up what the other threads have put since
+    cacheLock.acquire()
+    try:
+      self.load()
+    finally:
+      cacheLock.release()
+    try:
+      digest = self.hash(filename)
+    except (IOError,OSError),e:
+      if DEBUG: print "could not hash %s: %s" % (filename,e)
+      return None
+    return hashlib.sha1(digest + repr(sorted(settings.items()))).hexdigest()
+
+  def converted(self,key):
+    """
+    the converted file recorded for key if it and the other formats
+    converted with it are still there unchanged, otherwise None
+    """
+    entry = self.cache['converted'].get(key)
+    if not entry: return None
+    for (filename,stamp) in entry['files'].items():
+      if not os.path.exists(filename) or fileStamp(filename) != stamp:
+        return None
+    return entry['file']
+
+  def putConverted(self,key,convertedFile,files):
+    self.put('converted',key,
+             {'file': convertedFile,
+              'files': dict([(fn,fileStamp(fn)) for fn in files])})
+
+  def uploaded(self,key):
+    """
+    the remote file ID recorded for key or None
+    """
+    entry = self.cache['uploaded'].get(key)
+    return entry and entry['id']
+
+  def putUploaded(self,key,filename,remoteId):
+    self.put('uploaded',key,{'file': filename,'id': remoteId,
+                             'time': time.ctime()})
+
+
+if __name__ == '__main__':
+  # show the hashes of the files given
+  for filename in sys.argv[1:]:
+    print fileHash(filename),filename
@@ -0,0 +1,520 @@
+#!/usr/bin/python
+"""
+used by STELC_pi to convert a recorded wav file into compressed formats
+The wav file is read once, only the regions to keep, and its frames are
+fed to one encoder process per format at the same time, so an MP3 for
+distribution and a FLAC archive cost one pass over the SD card.
+No more than POOL_SIZE encoders (one per core) run at once, more formats
+than that are done POOL_SIZE at a time.
+Progress is kept as a dictionary in status and in progress ('42%'),
+clip is the count of clipped samples in the frames converted.
+RF64 wav files (see STELC_Recorder.SafeWave) are read as well.
+A recording longer than CHUNK_MIN_SECONDS is encoded to the CHUNK_FORMATS
+(MP3) on all the cores at once (unless CHUNK_MIN_SECONDS is 0), split
+into pieces that are encoded by
+separate CBR encoders without the bit reservoir, each with CHUNK_OVERLAP
+frames of the neighbouring pieces that are thrown away when the pieces
+are stitched back together.  The pieces start on MP3 frame boundaries so
+the frames line up with those of a single encode, and an Info (Xing/LAME)
+frame gives players the duration and the encoder delay and padding.
+If the pieces can not be encoded (without lame, say) the format is
+encoded in one pass with ENCODER after all.
+"""
+import os,sys,time
+import struct
+import shlex
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+import STELC_Supervisor as sP
+try:
+  import numpy
+except ImportError:
+  # clipped samples are not counted without NumPy
+  numpy = None
+
+DEBUG = 1
+# encoder fed raw frames on stdin, output to filename as type
+ENCODER = ('/usr/bin/sox -t raw -r %(rate)d -e signed -b %(bits)d -c %(channels)d - '
+           '-t %(type)s %(options)s %(filename)s')
+# sox options for each format
+FORMAT_OPTIONS = {'mp3': '-C 128',
+                  'flac': '-C 8',
+                  'ogg': '-C 3',
+                  'wav': ''}
+ENCODER_LOG = 'convert_stderr.log'
+# an encoder that takes no input for this many seconds is ended
+ENCODER_IDLE_TIMEOUT = 120
+# encoders run at once, one per core
+POOL_SIZE = multiprocessing.cpu_count()
+# bytes read from the wav file and fed to the encoders at a time
+READ_BYTES = 1024*1024
+# samples at or beyond this fraction of full scale count as clipped
+CLIP_LEVEL = 0.999
+# formats encoded in pieces on all the cores, for recordings longer
+# than CHUNK_MIN_SECONDS (0 for never), with CHUNK_PIECES pieces per core
+CHUNK_FORMATS = ['mp3']
+CHUNK_MIN_SECONDS = 5*60
+CHUNK_PIECES = 2
+# encoder for the pieces, CBR without the bit reservoir (--nores) so every
+# frame stands alone, and without a tag (-t) which is written at the end
+CHUNK_ENCODER = ('/usr/bin/lame -r -s %(khz)s --bitwidth %(bits)d --signed '
+                 '--little-endian -m %(mode)s -b %(bitrate)d --cbr --nores -t '
+                 '--quiet - %(filename)s')
+# kbps, the same as FORMAT_OPTIONS['mp3']
+CHUNK_BITRATE = 128
+# MP3 frames encoded before and after each piece and thrown away
+CHUNK_OVERLAP = 8
+# samples the encoder puts in front of the audio
+LAME_DELAY = 576
+LAME_VERSION = 'LAME3.100'
+
+# kbps by bitrate index for MPEG-1 and MPEG-2/2.5 Layer III
+MP3_BITRATES = {3: [0,32,40,48,56,64,80,96,112,128,160,192,224,256,320],
+                2: [0,8,16,24,32,40,48,56,64,80,96,112,128,144,160],
+                0: [0,8,16,24,32,40,48,56,64,80,96,112,128,144,160]}
+MP3_RATES = {3: [44100,48000,32000],
+             2: [22050,24000,16000],
+             0: [11025,12000,8000]}
+
+class ConvertError(Exception):
+  pass
+
+def readHeader(f):
+  """
+  return (channels,sampleWidth,rate,dataOffset,dataBytes) of the PCM
+  wav or RF64 file open as f, the data is cut to what is in the file
+  """
+  header = f.read(12)
+  if len(header) < 12: raise ConvertError, '%s is not a wav file' % f.name
+  riff,riffBytes,wave = struct.unpack('<4sI4s',header)
+  if riff not in ('RIFF','RF64') or wave != 'WAVE':
+    raise ConvertError, '%s is not a wav file' % f.name
+  fmt = None
+  ds64Bytes = None
+  while True:
+    header = f.read(8)
+    if len(header) < 8: raise ConvertError, 'no data in %s' % f.name
+    chunk,size = struct.unpack('<4sI',header)
+    if chunk == 'data': break
+    body = f.read(size + size % 2)
+    if chunk == 'fmt ' and len(body) >= 16: fmt = struct.unpack('<HHIIHH',body[:16])
+    elif chunk == 'ds64': ds64Bytes = struct.unpack('<Q',body[8:16])[0]
+  if not fmt or fmt[0] != 1: raise ConvertError, '%s is not PCM' % f.name
+  (tag,channels,rate,byteRate,blockAlign,bits) = fmt
+  dataOffset = f.tell()
+  if riff == 'RF64' and ds64Bytes is not None: size = ds64Bytes
+  size = min(size,os.fstat(f.fileno()).st_size - dataOffset)
+  size -= size % blockAlign
+  return (channels,bits//8,rate,dataOffset,size)
+
+def mp3Frame(header):
+  """
+  return (frameBytes,samplesPerFrame,sideInfoBytes) of the Layer III
+  frame starting with the 4 byte header or None if it is not one
+  """
+  if len(header) < 4: return None
+  (b0,b1,b2,b3) = struct.unpack('4B',header[:4])
+  version = (b1 >> 3) & 3
+  if b0 != 0xff or (b1 & 0xe0) != 0xe0 or version == 1 or (b1 >> 1) & 3 != 1:
+    return None
+  bitrateIndex = b2 >> 4
+  rateIndex = (b2 >> 2) & 3
+  if bitrateIndex in (0,15) or rateIndex == 3: return None
+  bitrate = MP3_BITRATES[version][bitrateIndex]*1000
+  rate = MP3_RATES[version][rateIndex]
+  padding = (b2 >> 1) & 1
+  mono = (b3 >> 6) == 3
+  if version == 3:
+    return (144*bitrate//rate + padding,1152,mono and 17 or 32)
+  return (72*bitrate//rate + padding,576,mono and 9 or 17)
+
+def mp3Frames(f):
+  """
+  yield the frames of the MP3 file open as f
+  """
+  while True:
+    header = f.read(4)
+    if len(header) < 4: return
+    frame = mp3Frame(header)
+    if not frame: raise ConvertError, 'lost MP3 frame sync in %s' % f.name
+    data = header + f.read(frame[0] - 4)
+    if len(data) < frame[0]: return
+    yield data
+
+def crc16(data,crc=0):
+  """
+  the CRC-16 (0x8005 reflected) of the LAME tag, over the frame up to it
+  """
+  for c in data:
+    crc ^= ord(c)
+    for bit in range(8):
+      if crc & 1: crc = (crc >> 1) ^ 0xa001
+      else: crc >>= 1
+  return crc
+
+def infoFrame(header,frames,musicBytes,delay,padding,bitrate):
+  """
+  an Info (Xing/LAME) frame for a CBR MP3 of frames frames after it with
+  the same header, musicBytes counts the Info frame as well
+  """
+  (b0,b1,b2,b3) = struct.unpack('4B',header[:4])
+  version = (b1 >> 3) & 3
+  # no CRC, no padding and a bitrate the Info frame fits in
+  b1 |= 1
+  for bitrateIndex in range((b2 >> 4),15):
+    head = struct.pack('4B',b0,b1,(bitrateIndex << 4) | (b2 & 0x0c),b3)
+    (frameBytes,samples,sideInfo) = mp3Frame(head)
+    if frameBytes >= 4 + sideInfo + 160: break
+  else:
+    raise ConvertError, 'no room for the Info frame'
+  musicBytes += frameBytes
+  tag = struct.pack('>4sIII','Info',0x0f,frames,musicBytes)
+  tag += ''.join([chr(256*i//100) for i in range(100)])
+  tag += struct.pack('>I',0)
+  # LAME extension, revision 0, CBR
+  tag += struct.pack('>9sBBIHHBB',LAME_VERSION,0x01,0,0,0,0,0,min(bitrate,255))
+  tag += struct.pack('>I',(min(delay,0xfff) << 12) | min(padding,0xfff))[1:]
+  tag += struct.pack('>BBHIH',0,0,0,musicBytes,0)
+  frame = head + '\0'*sideInfo + tag
+  frame += struct.pack('>H',crc16(frame))
+  return frame + '\0'*(frameBytes - len(frame))
+
+class Convert():
+  """
+  Converts a wav file to one or more formats, see convert()
+  """
+  def __init__(self):
+    self.progress = '0%'
+    self.clip = 0
+    self.status = {}
+    self.convertedFiles = {}
+    self.failed = []
+    self.cancelled = False
+    self.encoders = []
+    # the Supervisors of every encoder running, for cancel()
+    self.supervisors = []
+    self.log = None
+    # niceness the encoders run at, 19 to only use otherwise idle CPU
+    self.nice = 0
+    # frames of the pieces encoded so far, updated by the piece threads
+    self.lock = threading.Lock()
+    self.piecesDone = 0
+
+  def cancel(self):
+    """
+    stop a convert running in another thread, convert() then raises
+    """
+    self.cancelled = True
+    for supervisor in list(self.supervisors): supervisor.cancel()
+
+  def convert(self,filename,fmt='mp3',keep=None):
+    """
+    convert filename to fmt, or to each format in a list of them,
+    with the frames of the regions in keep ([[startFrame,endFrame],..])
+    or all of them, next to it with the format as the extension.
+    Returns the converted filename of the first format.
+    """
+    formats = isinstance(fmt,basestring) and [fmt] or list(fmt)
+    try:
+      f = open(filename,'rb')
+    except IOError,e:
+      raise ConvertError, 'could not open %s: %s' % (filename,e)
+    self.log = open(ENCODER_LOG,'a')
+    try:
+      (channels,sampleWidth,rate,dataOffset,dataBytes) = readHeader(f)
+      self.filename = filename
+      self.channels = channels
+      self.sampleWidth = sampleWidth
+      self.rate = rate
+      self.dataOffset = dataOffset
+      totalFrames = dataBytes//(channels*sampleWidth)
+      regions = [[max(0,start),min(end,totalFrames)]
+                 for (start,end) in (keep or [[0,totalFrames]])]
+      self.regions = [region for region in regions if region[1] > region[0]]
+      frames = sum([end - start for (start,end) in self.regions])
+      self.started = time.time()
+      base = os.path.splitext(filename)[0]
+      chunked = []
+      if POOL_SIZE > 1 and CHUNK_MIN_SECONDS and frames > CHUNK_MIN_SECONDS*rate:
+        chunked = [fmt for fmt in formats if fmt in CHUNK_FORMATS]
+      done = 0
+      for fmt in list(chunked):
+        if self.convertChunked(base,fmt,formats,done,frames): done += 1
+        else:
+          # encoded in one pass with the rest instead
+          chunked.remove(fmt)
+          if not done: self.clip = 0
+      rest = [fmt for fmt in formats if fmt not in chunked]
+      for n in range(0,len(rest),POOL_SIZE):
+        group = rest[n:n+POOL_SIZE]
+        self.start(group,base,channels,sampleWidth,rate)
+        position = 0
+        for data in self.readFrames(f,0,frames):
+          # clipped samples are counted on the first pass
+          self.feed(data,not done and sampleWidth)
+          position += len(data)//(channels*sampleWidth)
+          self.update(formats,done + len(group)*float(position)/max(frames,1),
+                      frames,rate)
+        self.finish()
+        done += len(group)
+        self.update(formats,done,frames,rate)
+    except:
+      # none of the encoders still going is kept half fed
+      for (fmt,outFile,supervisor) in self.encoders: supervisor.cancel()
+      raise
+    finally:
+      f.close()
+      self.finish()
+      self.log.close()
+    if DEBUG: print "converted %s to %s" % (filename,self.convertedFiles)
+    for fmt in formats:
+      if fmt in self.convertedFiles: return self.convertedFiles[fmt]
+    if self.cancelled: raise ConvertError, 'convert cancelled'
+    raise ConvertError, 'could not convert %s to %s' % (filename,formats)
+
+  def readFrames(self,f,start,end):
+    """
+    yield the data of frames start to end of the regions kept,
+    counted as if they followed each other
+    """
+    frameSize = self.channels*self.sampleWidth
+    offset = 0
+    for (regionStart,regionEnd) in self.regions:
+      first = max(start - offset,0) + regionStart
+      last = min(end - offset,regionEnd - regionStart) + regionStart
+      offset += regionEnd - regionStart
+      if last <= first: continue
+      f.seek(self.dataOffset + first*frameSize)
+      left = (last - first)*frameSize
+      while left:
+        data = f.read(min(left,READ_BYTES - READ_BYTES % frameSize))
+        if not data: return
+        left -= len(data)
+        yield data
+
+  def convertChunked(self,base,fmt,formats,done,frames):
+    """
+    encode the frames of the regions kept to the MP3 base.fmt in pieces
+    on all the cores and stitch them together, return False if that failed
+    """
+    samplesPerFrame = self.rate >= 32000 and 1152 or 576
+    frameCount = -(-frames//samplesPerFrame)
+    pieces = min(POOL_SIZE*CHUNK_PIECES,max(1,frameCount//(4*CHUNK_OVERLAP)))
+    length = -(-frameCount//pieces)*samplesPerFrame
+    self.pieces = [(start,min(start + length,frames))
+                   for start in range(0,frames,length)]
+    self.samplesPerFrame = samplesPerFrame
+    self.piecesDone = 0
+    self.progressArgs = (formats,done,frames)
+    outFile = '%s.%s' % (base,fmt)
+    if DEBUG: print "encoding %s in %d pieces" % (outFile,len(self.pieces))
+    pieceFiles = []
+    pool = ThreadPool(POOL_SIZE)
+    try:
+      pieceFiles = pool.map(self.encodePiece,range(len(self.pieces)))
+      if self.cancelled: raise ConvertError, 'convert cancelled'
+      if None in pieceFiles:
+        raise ConvertError, 'encoding a piece of %s failed' % outFile
+      self.stitch(outFile + '.part',pieceFiles,frames)
+      os.rename(outFile + '.part',outFile)
+      self.convertedFiles[fmt] = outFile
+    except ConvertError,e:
+      if DEBUG: print "encoding %s in pieces failed: %s" % (outFile,e)
+      if os.path.exists(outFile + '.part'): os.remove(outFile + '.part')
+      if self.cancelled: raise
+      return False
+    finally:
+      pool.close()
+      pool.join()
+      for n in range(len(self.pieces)):
+        pieceFile = '%s.part%d' % (os.path.splitext(self.filename)[0],n)
+        if os.path.exists(pieceFile): os.remove(pieceFile)
+    self.update(formats,done + 1,frames,self.rate)
+    return True
+
+  def encodePiece(self,n):
+    """
+    encode piece n with CHUNK_OVERLAP frames either side of it,
+    run in a pool thread, return the file or None if it failed
+    """
+    (start,end) = self.pieces[n]
+    frames = self.pieces[-1][1]
+    overlap = CHUNK_OVERLAP*self.samplesPerFrame
+    first = max(start - overlap,0)
+    last = min(end + overlap,frames)
+    pieceFile = '%s.part%d' % (os.path.splitext(self.filename)[0],n)
+    command = CHUNK_ENCODER % {'khz': '%g' % (self.rate/1000.),
+                               'bits': 8*self.sampleWidth,
+                               'mode': self.channels == 1 and 'm' or 'j',
+                               'bitrate': CHUNK_BITRATE,
+                               'filename': pieceFile}
+    if DEBUG and not n: print "encoder command: %s" % command
+    try:
+      supervisor = self.encoder(command)
+    except ConvertError,e:
+      if DEBUG: print e
+      return None
+    frameSize = self.channels*self.sampleWidth
+    f = None
+    position = first
+    try:
+      f = open(self.filename,'rb')
+      for data in self.readFrames(f,first,last):
+        if self.cancelled: break
+        # clipped samples of the overlap are counted by the neighbour
+        count = len(data)//frameSize
+        inside = data[max(start - position,0)*frameSize:
+                      max(end - position,0)*frameSize]
+        position += count
+        supervisor.write(data)
+        self.lock.acquire()
+        self.countClips(inside,self.sampleWidth)
+        self.piecesDone += len(inside)//frameSize
+        self.lock.release()
+        (formats,done,total) = self.progressArgs
+        self.update(formats,done + float(self.piecesDone)/max(total,1),
+                    total,self.rate)
+    except sP.SupervisorError:
+      # the encoder died or was ended
+      pass
+    except (IOError,OSError),e:
+      # the piece fails, not the thread running it
+      if DEBUG: print "encoding %s: %s" % (pieceFile,e)
+      supervisor.cancel()
+    if f: f.close()
+    state = supervisor.wait()
+    self.supervisors.remove(supervisor)
+    if state != 'done' or self.cancelled:
+      if DEBUG: print "encoding %s %s" % (pieceFile,state)
+      if os.path.exists(pieceFile): os.remove(pieceFile)
+      return None
+    return pieceFile
+
+  def stitch(self,outFile,pieceFiles,frames):
+    """
+    put together the MP3 frames of each piece without those of the
+    overlap, behind an Info frame
+    """
+    out = open(outFile,'wb')
+    info = None
+    written = 0
+    musicBytes = 0
+    for (n,pieceFile) in enumerate(pieceFiles):
+      (start,end) = self.pieces[n]
+      lead = min(start,CHUNK_OVERLAP*self.samplesPerFrame)//self.samplesPerFrame
+      # the last piece keeps the frames the encoder flushes at the end
+      keep = n < len(pieceFiles) - 1 and (end - start)//self.samplesPerFrame
+      f = open(pieceFile,'rb')
+      kept = 0
+      for (k,frame) in enumerate(mp3Frames(f)):
+        if k < lead: continue
+        if keep and kept == keep: break
+        if info is None:
+          # make room for the Info frame, written once it is all known
+          info = frame[:4]
+          out.write(infoFrame(info,0,0,0,0,CHUNK_BITRATE))
+        out.write(frame)
+        musicBytes += len(frame)
+        kept += 1
+      f.close()
+      if keep and kept < keep:
+        raise ConvertError, 'piece %d has %d frames not %d' % (n,kept,keep)
+      written += kept
+    if info is None: raise ConvertError, 'no MP3 frames encoded'
+    padding = max(written*self.samplesPerFrame - frames - LAME_DELAY,0)
+    out.seek(0)
+    out.write(infoFrame(info,written,musicBytes,LAME_DELAY,padding,CHUNK_BITRATE))
+    out.close()
+
+  def start(self,formats,base,channels,sampleWidth,rate):
+    """
+    start an encoder for each of formats, writing to a temporary
+    file that is renamed once it is complete
+    """
+    for fmt in formats:
+      outFile = '%s.%s' % (base,fmt)
+      command = ENCODER % {'rate': rate,'bits': 8*sampleWidth,
+                           'channels': channels,'type': fmt,
+                           'options': FORMAT_OPTIONS.get(fmt,''),
+                           'filename': outFile + '.part'}
+      if DEBUG: print "encoder command: %s" % command
+      self.encoders.append((fmt,outFile,self.encoder(command)))
+
+  def encoder(self,command):
+    """
+    start command as an encoder fed on its stdin and return its Supervisor
+    """
+    supervisor = sP.Supervisor(shlex.split(command),input=True,
+                               stdoutLog=self.log,stderrLog=self.log,
+                               idleTimeout=ENCODER_IDLE_TIMEOUT,nice=self.nice)
+    self.supervisors.append(supervisor)
+    if self.cancelled: supervisor.cancel()
+    try:
+      supervisor.start()
+    except OSError,e:
+      # missing or not executable
+      self.supervisors.remove(supervisor)
+      raise ConvertError, 'could not start %s: %s' % (command,e)
+    return supervisor
+
+  def feed(self,data,sampleWidth=None):
+    """
+    write data to every encoder still going, with the sampleWidth
+    count the clipped samples in it
+    """
+    if self.cancelled: raise ConvertError, 'convert cancelled'
+    self.countClips(data,sampleWidth)
+    for (fmt,outFile,supervisor) in self.encoders:
+      if supervisor.process.stdin.closed: continue
+      try:
+        supervisor.write(data)
+      except sP.SupervisorError:
+        # the encoder died, finish() finds out why
+        supervisor.closeInput()
+
+  def countClips(self,data,sampleWidth):
+    if numpy and sampleWidth in (2,4):
+      samples = numpy.frombuffer(data,dtype='<i%d' % sampleWidth)
+      clipLevel = int(CLIP_LEVEL*2**(8*sampleWidth-1))
+      self.clip += int(numpy.count_nonzero(samples >= clipLevel) +
+                       numpy.count_nonzero(samples <= -clipLevel))
+
+  def finish(self):
+    """
+    close the encoders' input, wait for them and keep the outputs
+    of those that succeeded
+    """
+    for (fmt,outFile,supervisor) in self.encoders:
+      state = supervisor.wait()
+      self.supervisors.remove(supervisor)
+      if state == 'done' and not self.cancelled:
+        os.rename(outFile + '.part',outFile)
+        self.convertedFiles[fmt] = outFile
+      else:
+        self.failed.append(fmt)
+        if os.path.exists(outFile + '.part'): os.remove(outFile + '.part')
+        if DEBUG: print "encoding %s %s" % (outFile,state)
+    self.encoders = []
+
+  def update(self,formats,formatsDone,frames,rate):
+    """
+    replace the status with the progress over all the formats
+    """
+    fraction = float(formatsDone)/len(formats)
+    elapsed = time.time() - self.started
+    self.status = {'fraction': fraction,
+                   'elapsed': elapsed,
+                   'remaining': fraction and elapsed*(1. - fraction)/fraction,
+                   'seconds': float(frames)/rate,
+                   'formats': formats,
+                   'converted': self.convertedFiles.keys(),
+                   'failed': list(self.failed),
+                   'clip': self.clip}
+    self.progress = '%d%%' % int(100*fraction)
+
+
+if __name__ == '__main__':
+  c = Convert()
+  print c.convert(sys.argv[1],sys.argv[2:] or 'mp3')
+  print c.status
@@ -5,10 +5,13 @@ copy over the wav and log files and unmount the drive
 """
 import re,sys
 import subprocess,time
+import STELC_Supervisor as sP
 
 DEBUG = 1
 PROGRESS_CHARS = ['.','^','>','v','<']
 COPYCMD = "rsync -Pt --modify-window=2 --include='*.mp3' --include='*.wav' --include='*.log' --exclude='*' ./* %s/STELC_pi/" # command used to copy the files the %s is the USB mount point
+# a copy that shows no progress for this many seconds is ended
+COPY_IDLE_TIMEOUT = 120
 
 class Copy():
   """
@@ -19,6 +22,18 @@ class Copy():
     self.incrProgress()
     self.devDict = {}
     self.usbDevices = []
+    self.supervisor = None
+    self.cancelled = False
+    self.mntCount = 0
+    self.fileCount = 0
+
+  def cancel(self):
+    """
+    stop a copy running in another thread, the sticks are still unmounted
+    """
+    self.cancelled = True
+    supervisor = self.supervisor
+    if supervisor: supervisor.cancel()
 
   def incrProgress(self):
     self.progressCount += 1
@@ -137,40 +152,26 @@ class Copy():
     pipeOut = open('copy_stdout.log','w')
     pipeErr = open('copy_stderr.log','w')
     # loop trough each mounted stick
-    mntCount = 0
+    self.mntCount = 0
     for mnt in self.getUsbMounts(self.usbDevices):
-      mntCount += 1
-      fileCount = 0
-      # open the pipe with the copy command
+      if self.cancelled: break
+      self.mntCount += 1
+      self.fileCount = 0
+      # run the copy command
       copyCmd = COPYCMD % mnt
       if DEBUG: print "copy command: %s" % copyCmd
       pipeOut.write("copy command: %s\n" % copyCmd)
       pipeErr.write("copy command: %s\n" % copyCmd)
-      copyPipe = subprocess.Popen(copyCmd,
-        shell=True,
-        bufsize=-1,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-        close_fds=True)
-      # poll lack of completion
-      while copyPipe.poll() == None:
-        # read any lines produced
-        line = copyPipe.stdout.readline()
-        while line:
-          pipeOut.write(line)
-          pipeOut.flush()
-          # count files
-          if re.search('^[^ ]',line): fileCount += 0.5
-          else: 
-            # extract % complete for each file
-            myMatch = re.search('\s([0-9]+%)\s',line)
-            if myMatch: self.progress = "%d.%d %s" % (mntCount,fileCount,myMatch.group(1))
-            if DEBUG: print "rsync progress %s" % self.progress
-          line = copyPipe.stdout.readline()
-
-      pipeErr.writelines(copyPipe.stderr.readlines())
-      if DEBUG: print "rsync done %s" % copyPipe.poll()
+      pipeOut.flush()
+      pipeErr.flush()
+      self.supervisor = sP.Supervisor(copyCmd,shell=True,
+                                      parser=self.parseCopy,
+                                      stdoutLog=pipeOut,stderrLog=pipeErr,
+                                      idleTimeout=COPY_IDLE_TIMEOUT)
+      if self.cancelled: self.supervisor.cancel()
+      state = self.supervisor.run()
+      self.supervisor = None
+      if DEBUG: print "rsync %s" % state
 
     pipeOut.close()
     pipeErr.close()
@@ -189,10 +190,29 @@ class Copy():
         #self.progress = "%s detach fail" % self.devDict[usbDev[0]]['label']
         if DEBUG: print  "%s detach fail" % self.devDict[usbDev[0]]['label']
         time.sleep(2.0)
+    if self.cancelled:
+      self.progress = "CANCELLED"
+      if DEBUG: print "CANCELLED"
+      return
     self.progress = "DONE"
     if DEBUG: print "DONE"
     time.sleep(10.0)
 
+  def parseCopy(self,stream,line):
+    """
+    progress as stick.files percent from a line of rsync -P output
+    """
+    if stream != 'stdout': return None
+    # count files
+    if re.search('^[^ ]',line): self.fileCount += 0.5
+    else:
+      # extract % complete for each file
+      myMatch = re.search('\s([0-9]+%)\s',line)
+      if myMatch:
+        self.progress = "%d.%d %s" % (self.mntCount,self.fileCount,myMatch.group(1))
+      if DEBUG: print "rsync progress %s" % self.progress
+    return self.progress
+
 
 if __name__ == '__main__':
   c = Copy()
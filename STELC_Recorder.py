@@ -1,7 +1,19 @@
 #!/usr/bin/python
 
-import os,sys,time
-import subprocess
+import os,sys,time,glob
+import subprocess,shlex
+import tempfile,shutil
+import threading,Queue
+import socket,SocketServer,BaseHTTPServer
+import struct,math,bisect,fractions
+import hashlib
+import yaml
+import ctypes,ctypes.util
+try:
+  import numpy
+except ImportError:
+  # level metering is skipped without NumPy
+  numpy = None
 import pyaudio
 import wave
 
@@ -41,9 +53,1585 @@ INPUT_CHANNELS = 1
 SAMPLING_RATE = 48000
 SECONDS = 10
 
+# seconds of audio the ring buffer between the callback and the
+# writer thread can hold before incoming buffers get dropped
+RING_BUFFER_SECONDS = 30
+# the writer thread writes once this many bytes are waiting
+WRITE_BATCH_BYTES = 1024*1024
+# or once this many seconds have passed since its last write
+WRITE_BATCH_DELAY = 2.0
+# how often the writer thread checks the ring buffer
+WRITER_POLL = 0.1
+# upper edges in seconds of the callback interval and latency histogram
+# buckets, the last bucket counts everything above the last edge
+TIME_EDGES = [0.001,0.002,0.005,0.01,0.02,0.05,0.1,0.2,0.5,1.,2.,5.]
+# upper edges of the ring buffer fill histogram, as a fraction of its size
+FILL_EDGES = [0.01,0.02,0.05,0.1,0.2,0.5,0.8,0.9,1.]
+# callback stats and ring buffer stats are dumped here at the end of a
+# recording, replaces the .wav extension
+STATS_SIDECAR = '.stats.yaml'
+# frames_per_buffer values tried by calibrate()
+CALIBRATION_CHUNKS = [1024,2048,4096,8192,16384,32768,65536]
+# seconds each one is recorded for
+CALIBRATION_SECONDS = 20
+# worst callback interval allowed beyond the buffer period, as a
+# fraction of the period, for a chunk size to count as steady
+CALIBRATION_JITTER_LIMIT = 0.5
+# the calibrated chunk per device and sampling rate,
+# used by Record when it is not given a chunk
+CALIBRATION_FILENAME = 'STELC_calibration.yaml'
+# rate the recording is stored at, the frames are resampled from
+# SAMPLING_RATE in the writer thread (see Resampler), 0 to store as captured
+STORE_RATE = 0
+# zero crossings either side of the resampling filter, more is sharper
+# but slower, its cutoff as a fraction of the lower Nyquist frequency,
+# Kaiser window beta and output frames resampled per NumPy pass
+RESAMPLE_ZERO_CROSSINGS = 16
+RESAMPLE_ROLLOFF = 0.9
+RESAMPLE_BETA = 8.
+RESAMPLE_BLOCK_FRAMES = 4096
+# processing applied in the writer thread after any resampling
+# (see DSPChain), a list of (stage,setting) run in order from
+#   ('highpass',Hz) rumble filter, ('gain',dB) fixed gain and
+#   ('limit',dBFS) soft limiter that starts to bend at that level
+# such as [('highpass',80.),('gain',6.),('limit',-3.)]
+DSP_CHAIN = []
+# default seconds of audio kept from before the start of a recording
+# by Record.preroll(), must be less than RING_BUFFER_SECONDS
+PREROLL_SECONDS = 10
+# a Session checks its streams every RECONNECT_POLL seconds, and reopens
+# one that died by itself (a USB device glitch), trying again every
+# RECONNECT_RETRY_SECONDS until its recording time runs out
+RECONNECT_POLL = 0.5
+RECONNECT_RETRY_SECONDS = 1.0
+# inserted before the extension of the recording filename for the file
+# of each channel when they are split, and for the devices after the first
+CHANNEL_FORMAT = '.ch%d'
+DEVICE_FORMAT = '.dev%d'
+# inserted before the extension of the recording filename to number segments
+# STELC_20140406-1013.wav -> STELC_20140406-1013.001.wav so they still
+# match the PURGE_RE in STELC_pi
+SEGMENT_FORMAT = '.%03d'
+# encoder fed with raw frames on stdin while recording, the compressed
+# format (mp3, flac, opus, ...) is taken from the extension of %(filename)s
+ENCODER = '/usr/bin/sox -t raw -r %(rate)d -e signed -b %(bits)d -c %(channels)d - %(filename)s'
+# where the encoder's stdout and stderr go
+ENCODER_LOG = 'encode_stderr.log'
+# batches the encoder can fall behind before it is given up on, the wav
+# is converted afterwards instead
+ENCODER_BATCHES = 16
+# SafeWave collects this many bytes before writing, writes are aligned to it
+WAVE_BLOCK_BYTES = 1024*1024
+# seconds between SafeWave header rewrites, the file on disk is always
+# playable up to the last of these checkpoints
+WAVE_CHECKPOINT_SECONDS = 30
+# when SafeWave calls fsync: 'never' leaves it to the OS,
+# 'checkpoint' at every header rewrite and 'always' after every write
+WAVE_FSYNC = 'checkpoint'
+# length of the header written by waveHeader()
+WAVE_HEADER_BYTES = 44
+# RIFF sizes are 32 bit, a wave file bigger than this has to be RF64
+RIFF_LIMIT = 0xffffffff
+# length of the header written by rf64Header()
+RF64_HEADER_BYTES = 80
+# when SafeWave leaves room in the header to become RF64: 'auto' when the
+# expected size is past RIFF_LIMIT, 'always' or 'never' (the sizes in
+# the header then stop at RIFF_LIMIT)
+WAVE_RF64 = 'auto'
+# journal of a SafeWave being written, replaces the .wav extension, it is
+# rewritten at every checkpoint and removed when the file is closed, so
+# one left behind marks a recording cut short (see recoverWaves())
+JOURNAL_SIDECAR = '.journal.yaml'
+# SHA-1 of the audio of a SafeWave, worked out as it is written and kept
+# with the file's size and mtime when it is closed, replaces the .wav
+# extension (see audioHash() and readHash())
+HASH_SIDECAR = '.sha1.yaml'
+# samples at or beyond this fraction of full scale count as clipped
+CLIP_LEVEL = 0.999
+# level reported in dBFS for digital silence
+LEVEL_FLOOR = -99.
+# windows quieter than SILENCE_LEVEL dBFS RMS count as silence
+SILENCE_LEVEL = -50.
+SILENCE_WINDOW_SECONDS = 0.5
+# silent stretches at least this long are listed in the sidecar
+SILENCE_MIN_SECONDS = 10
+# silent stretches inside the recording at least this long can be skipped
+SILENCE_SKIP_SECONDS = 120
+# audio kept either side of the trim points and skipped stretches
+SILENCE_PAD_SECONDS = 2
+# sidecar file with the detected regions, replaces the .wav extension
+SILENCE_SIDECAR = '.silence.yaml'
+# samples per min/max pair of each level of the peak index, finest first,
+# each one a multiple of the one before (an empty list skips the index)
+PEAK_LEVELS = [256,4096,65536]
+# peak index sidecar, replaces the .wav extension (see PeakIndex)
+PEAKS_SIDECAR = '.peaks.dat'
+# every sidecar written next to a recording (see sidecars())
+SIDECARS = (STATS_SIDECAR,JOURNAL_SIDECAR,HASH_SIDECAR,SILENCE_SIDECAR,
+            PEAKS_SIDECAR)
+# port the recording is served on live over HTTP as a WAV stream
+# (see LiveStream), 0 for none, and the address to listen on
+LIVE_PORT = 0
+LIVE_ADDRESS = ''
+# batches a live listener can fall behind before its batches are dropped
+LIVE_CLIENT_BATCHES = 32
+# seconds between writer batches while serving live, shorter than
+# WRITE_BATCH_DELAY to keep the listeners close behind
+LIVE_BATCH_DELAY = 0.2
+
 class RecordingError(Exception):
   pass
 
+class RingBuffer():
+  """
+  A preallocated byte ring buffer with a single producer (the PortAudio
+  callback) and a single consumer (the Writer thread).
+  head is the total bytes ever written and is only moved by write(),
+  tail is the total bytes ever read and is only moved by consume(),
+  so neither side needs a lock.  If the writer falls behind and the
+  buffer fills, whole incoming buffers are dropped and counted rather
+  than making the callback wait.
+  """
+  def __init__(self,size):
+    self.size = size
+    self.buf = bytearray(size)
+    self.view = memoryview(self.buf)
+    self.head = 0
+    self.tail = 0
+    # deepest the buffer has been
+    self.highWater = 0
+    # bytes and buffers dropped because the buffer was full
+    self.droppedBytes = 0
+    self.droppedBuffers = 0
+
+  def depth(self):
+    """
+    bytes waiting to be read
+    """
+    return self.head - self.tail
+
+  def write(self,data):
+    """
+    copy data into the buffer, return False if it had to be dropped
+    """
+    n = len(data)
+    if n > self.size - (self.head - self.tail): return self.drop(n)
+    src = memoryview(data)
+    start = self.head % self.size
+    first = min(n,self.size - start)
+    self.view[start:start+first] = src[:first]
+    if first < n: self.view[0:n-first] = src[first:]
+    self.head += n
+    depth = self.head - self.tail
+    if depth > self.highWater: self.highWater = depth
+    return True
+
+  def writeSilence(self,n):
+    """
+    like write() but of n zero bytes
+    """
+    if n > self.size - (self.head - self.tail): return self.drop(n)
+    start = self.head % self.size
+    first = min(n,self.size - start)
+    self.view[start:start+first] = bytearray(first)
+    if first < n: self.view[0:n-first] = bytearray(n-first)
+    self.head += n
+    depth = self.head - self.tail
+    if depth > self.highWater: self.highWater = depth
+    return True
+
+  def drop(self,n):
+    """
+    count a buffer of n bytes as dropped, returns False like write()
+    """
+    self.droppedBytes += n
+    self.droppedBuffers += 1
+    return False
+
+  def peek(self):
+    """
+    return a list of (at most two) memoryviews covering everything
+    currently waiting, without moving the tail
+    """
+    n = self.head - self.tail
+    start = self.tail % self.size
+    first = min(n,self.size - start)
+    views = [self.view[start:start+first]]
+    if first < n: views.append(self.view[0:n-first])
+    return views
+
+  def consume(self,n):
+    """
+    release n bytes once they have been written out
+    """
+    self.tail += n
+
+  def stats(self):
+    return {'size': self.size,
+            'depth': self.depth(),
+            'highWater': self.highWater,
+            'droppedBytes': self.droppedBytes,
+            'droppedBuffers': self.droppedBuffers}
+
+class Histogram():
+  """
+  Counts of values falling in buckets with the given upper edges.
+  Only one thread may add() but any thread can take a snapshot().
+  """
+  def __init__(self,edges):
+    self.edges = edges
+    self.counts = [0]*(len(edges)+1)
+    self.count = 0
+    self.total = 0.
+    self.max = 0.
+
+  def add(self,value):
+    self.counts[bisect.bisect_left(self.edges,value)] += 1
+    self.count += 1
+    self.total += value
+    if value > self.max: self.max = value
+
+  def snapshot(self):
+    count = self.count
+    return {'edges': list(self.edges),
+            'counts': list(self.counts),
+            'count': count,
+            'mean': count and self.total/count or 0.,
+            'max': self.max}
+
+class CallbackStats():
+  """
+  Counters and histograms updated by the PortAudio callback instead of
+  printing from it.  Only the callback writes them, so there are no
+  locks, and snapshot() can be read from any thread at any time.
+    interval: seconds between callbacks (stream time)
+    latency: seconds from the ADC time of a buffer until it is expected
+             to be written, the callback's own delay plus the audio
+             already waiting ahead of it in the ring buffer, left out
+             (and counted in noAdcTime) when the host API gives no ADC
+             time (0)
+    fill: ring buffer depth as a fraction of its size
+  """
+  def __init__(self,bytesPerSecond):
+    self.bytesPerSecond = float(bytesPerSecond)
+    self.calls = 0
+    self.frames = 0
+    self.noAdcTime = 0
+    self.firstCall = None
+    self.lastCall = None
+    self.interval = Histogram(TIME_EDGES)
+    self.latency = Histogram(TIME_EDGES)
+    self.fill = Histogram(FILL_EDGES)
+
+  def update(self,frameCount,timeInfo,ring):
+    now = timeInfo['current_time']
+    if self.lastCall is not None: self.interval.add(now - self.lastCall)
+    else: self.firstCall = now
+    self.lastCall = now
+    depth = ring.head - ring.tail
+    adcTime = timeInfo['input_buffer_adc_time']
+    if adcTime: self.latency.add(now - adcTime + depth/self.bytesPerSecond)
+    else: self.noAdcTime += 1
+    self.fill.add(float(depth)/ring.size)
+    self.calls += 1
+    self.frames += frameCount
+
+  def snapshot(self,errorCounter):
+    """
+    the stats along with the errorCounter counts and their rates per hour
+    """
+    elapsed = 0.
+    if self.firstCall is not None: elapsed = self.lastCall - self.firstCall
+    errors = dict(errorCounter)
+    rates = {}
+    for key in errors.keys():
+      rates[key] = elapsed and errors[key]*3600./elapsed or 0.
+    return {'calls': self.calls,
+            'frames': self.frames,
+            'noAdcTime': self.noAdcTime,
+            'elapsed': elapsed,
+            'interval': self.interval.snapshot(),
+            'latency': self.latency.snapshot(),
+            'fill': self.fill.snapshot(),
+            'errors': errors,
+            'errorsPerHour': rates}
+
+class PrerollBuffer():
+  """
+  A preallocated buffer which always holds the most recent size bytes
+  written to it, the oldest audio is overwritten by new buffers.
+  """
+  def __init__(self,size):
+    self.size = size
+    self.buf = bytearray(size)
+    self.view = memoryview(self.buf)
+    # total bytes ever written
+    self.head = 0
+
+  def write(self,data):
+    n = len(data)
+    src = memoryview(data)
+    # only the end of a buffer bigger than the whole preroll matters
+    if n > self.size:
+      self.head += n - self.size
+      src = src[n-self.size:]
+      n = self.size
+    start = self.head % self.size
+    first = min(n,self.size - start)
+    self.view[start:start+first] = src[:first]
+    if first < n: self.view[0:n-first] = src[first:]
+    self.head += n
+
+  def peek(self):
+    """
+    return a list of (at most two) memoryviews of the contents, oldest first
+    """
+    n = min(self.head,self.size)
+    start = (self.head - n) % self.size
+    first = min(n,self.size - start)
+    views = [self.view[start:start+first]]
+    if first < n: views.append(self.view[0:n-first])
+    return views
+
+class Writer(threading.Thread):
+  """
+  Drains a RingBuffer to its outputs in large batches so that slow
+  SD card writes happen here instead of in the PortAudio callback.
+  An output is anything with writeframes() and close() methods,
+  like the wave.Wave_write returned by wave.open().
+  The frames pass through the filters in order on the way, a filter
+  is anything with a process(data) method returning the frames to pass
+  on and a flush() method returning any it still holds at the end.
+  taps are outputs given the frames as captured, ahead of the filters.
+  """
+  def __init__(self,ring,outputs,filters=None,taps=None):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.ring = ring
+    self.outputs = outputs
+    self.filters = filters or []
+    self.taps = taps or []
+    self.batchBytes = WRITE_BATCH_BYTES
+    self.batchDelay = WRITE_BATCH_DELAY
+    self.bytesWritten = 0
+    self.batches = 0
+    self._stop_ = threading.Event()
+
+  def stop(self):
+    """
+    write out anything left in the ring buffer and end the thread
+    """
+    self._stop_.set()
+    self.join()
+
+  def stopped(self):
+    return self._stop_.isSet()
+
+  def run(self):
+    lastWrite = time.time()
+    while not self.stopped():
+      depth = self.ring.depth()
+      if (depth >= self.batchBytes or
+          (depth and time.time() - lastWrite >= self.batchDelay)):
+        self.drain()
+        lastWrite = time.time()
+      time.sleep(WRITER_POLL)
+    self.drain()
+    self.flush()
+
+  def drain(self):
+    """
+    write everything currently in the ring buffer to all outputs
+    """
+    n = 0
+    for view in self.ring.peek():
+      n += len(view)
+      for tap in self.taps: tap.writeframes(view)
+      self.write(view)
+    self.ring.consume(n)
+    self.bytesWritten += n
+    self.batches += 1
+    if DEBUG > 1: print "writer wrote %d bytes, %d waiting" % (n,self.ring.depth())
+
+  def write(self,data,filters=None):
+    """
+    pass data through the filters (all of them by default) to the outputs
+    """
+    if filters is None: filters = self.filters
+    for f in filters: data = f.process(data)
+    if not len(data): return
+    for output in self.outputs: output.writeframes(data)
+
+  def flush(self):
+    """
+    write what the filters still hold through the filters after them
+    """
+    for (i,f) in enumerate(self.filters):
+      self.write(f.flush(),self.filters[i+1:])
+
+def waveHeader(channels,sampleWidth,rate,dataBytes):
+  """
+  return the canonical 44 byte PCM RIFF header for dataBytes of frames
+  """
+  dataBytes = min(dataBytes,RIFF_LIMIT - 36)
+  return struct.pack('<4sI4s4sIHHIIHH4sI',
+                     'RIFF',36+dataBytes,'WAVE',
+                     'fmt ',16,1,channels,rate,
+                     rate*channels*sampleWidth,channels*sampleWidth,
+                     8*sampleWidth,
+                     'data',dataBytes)
+
+def rf64Header(channels,sampleWidth,rate,dataBytes):
+  """
+  return the 80 byte PCM header for dataBytes of frames that is RIFF
+  with a JUNK chunk while the sizes fit in 32 bits, and is RF64 with the
+  JUNK replaced by a ds64 chunk holding the real sizes once they do not
+  (EBU Tech 3306), so the file can grow past RIFF_LIMIT while it is written
+  """
+  riffBytes = RF64_HEADER_BYTES - 8 + dataBytes
+  fmt = struct.pack('<4sIHHIIHH','fmt ',16,1,channels,rate,
+                    rate*channels*sampleWidth,channels*sampleWidth,
+                    8*sampleWidth)
+  if riffBytes <= RIFF_LIMIT:
+    return (struct.pack('<4sI4s4sI','RIFF',riffBytes,'WAVE','JUNK',28) +
+            '\0'*28 + fmt + struct.pack('<4sI','data',dataBytes))
+  return (struct.pack('<4sI4s','RF64',RIFF_LIMIT,'WAVE') +
+          struct.pack('<4sIQQQI','ds64',28,riffBytes,dataBytes,
+                      dataBytes//(channels*sampleWidth),0) +
+          fmt + struct.pack('<4sI','data',RIFF_LIMIT))
+
+def headerFor(headerBytes,channels,sampleWidth,rate,dataBytes):
+  """
+  the header of headerBytes, from waveHeader() or rf64Header()
+  """
+  if headerBytes == RF64_HEADER_BYTES: makeHeader = rf64Header
+  else: makeHeader = waveHeader
+  return makeHeader(channels,sampleWidth,rate,dataBytes)
+
+def preallocate(fd,size):
+  """
+  reserve size bytes on disk for the file open on fd so it does not
+  fragment the card as it grows, returns False if that is not possible
+  """
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+    fallocate = libc.posix_fallocate64
+  except (OSError,AttributeError):
+    return False
+  fallocate.argtypes = [ctypes.c_int,ctypes.c_int64,ctypes.c_int64]
+  return fallocate(fd,0,size) == 0
+
+def asSamples(data,dtype):
+  """
+  view data (a str, bytearray or memoryview) as a NumPy array of dtype
+  without copying it
+  """
+  if isinstance(data,memoryview): return numpy.asarray(data).view(dtype)
+  return numpy.frombuffer(data,dtype=dtype)
+
+def dBFS(level):
+  """
+  convert a fraction of full scale to dB, LEVEL_FLOOR for silence
+  """
+  if level <= 0: return LEVEL_FLOOR
+  return max(LEVEL_FLOOR,20.*math.log10(level))
+
+class Resampler():
+  """
+  A writer filter converting the frames from rateIn to rateOut with a
+  polyphase windowed sinc filter, vectorized with NumPy over blocks
+  of RESAMPLE_BLOCK_FRAMES output frames.  The filter delay is taken out
+  so the output lines up with the input from the first frame, and the
+  output has rateOut/rateIn as many frames as the input.
+  """
+  def __init__(self,channels,sampleWidth,rateIn,rateOut):
+    if not numpy: raise RecordingError, 'NumPy is needed to resample'
+    if sampleWidth not in (2,4):
+      raise RecordingError, 'can not resample %d byte samples' % sampleWidth
+    gcd = fractions.gcd(rateIn,rateOut)
+    self.up = rateOut//gcd
+    self.down = rateIn//gcd
+    self.channels = channels
+    self.dtype = '<i%d' % sampleWidth
+    self.fullScale = 2**(8*sampleWidth-1)
+    # low pass below the lower Nyquist frequency at the up sampled rate
+    factor = max(self.up,self.down)
+    self.delay = RESAMPLE_ZERO_CROSSINGS*factor
+    n = numpy.arange(-self.delay,self.delay+1)
+    cutoff = RESAMPLE_ROLLOFF/factor
+    h = (self.up*cutoff*numpy.sinc(cutoff*n)*
+         numpy.kaiser(len(n),RESAMPLE_BETA))
+    # output frame m is the up sampled frame t = m*down + delay, its
+    # phase t % up of the filter is applied to the taps input frames
+    # ending at t//up, oldest first
+    self.taps = -(-len(h)//self.up)
+    h = numpy.concatenate([h,numpy.zeros(self.taps*self.up - len(h))])
+    self.phases = h.reshape(self.taps,self.up).T[:,::-1]
+    # input frames kept as floats, from frame bufferStart on
+    self.buffer = numpy.zeros((self.taps,channels))
+    self.bufferStart = -self.taps
+    self.inFrames = 0
+    self.outFrames = 0
+
+  def process(self,data):
+    frames = asSamples(data,self.dtype).reshape(-1,self.channels)
+    self.buffer = numpy.concatenate([self.buffer,frames])
+    self.inFrames += len(frames)
+    return self.resample(self.inFrames)
+
+  def flush(self):
+    """
+    pad the input with silence to finish the last output frames
+    """
+    total = self.inFrames*self.up//self.down
+    if total <= self.outFrames: return ''
+    needed = ((total - 1)*self.down + self.delay)//self.up + 1
+    padding = needed - (self.bufferStart + len(self.buffer))
+    if padding > 0:
+      self.buffer = numpy.concatenate([self.buffer,
+                                       numpy.zeros((padding,self.channels))])
+    return self.resample(needed,total)
+
+  def resample(self,available,total=None):
+    """
+    return the output frames whose input up to frame available is in
+    the buffer (no more than total frames in all) and drop the input
+    frames no longer needed
+    """
+    end = (available*self.up - 1 - self.delay)//self.down + 1
+    if total is not None: end = min(end,total)
+    blocks = []
+    window = numpy.arange(self.taps)
+    while self.outFrames < end:
+      m = numpy.arange(self.outFrames,
+                       min(end,self.outFrames + RESAMPLE_BLOCK_FRAMES))
+      t = m*self.down + self.delay
+      first = t//self.up - (self.taps - 1) - self.bufferStart
+      frames = self.buffer[first[:,None] + window]
+      blocks.append(numpy.einsum('mk,mkc->mc',self.phases[t % self.up],frames))
+      self.outFrames = m[-1] + 1
+    t = self.outFrames*self.down + self.delay
+    drop = min(len(self.buffer),t//self.up - (self.taps - 1) - self.bufferStart)
+    if drop > 0:
+      self.buffer = self.buffer[drop:]
+      self.bufferStart += drop
+    if not blocks: return ''
+    out = numpy.clip(numpy.round(numpy.concatenate(blocks)),
+                     -self.fullScale,self.fullScale - 1)
+    return out.astype(self.dtype).tostring()
+
+class HighPass():
+  """
+  DSPChain stage taking out rumble below cutoff Hz, the input less
+  two cascaded moving averages of it (done with cumulative sums)
+  so it is linear phase, the delay is taken out
+  """
+  def __init__(self,channels,rate,cutoff):
+    # the filter is down 3 dB at about 0.57 of rate/length
+    self.length = max(3,int(round(0.57*rate/cutoff)) | 1)
+    self.delay = self.length - 1
+    self.history = numpy.zeros((self.delay,channels))
+    self.setting = 'highpass %gHz' % cutoff
+
+  def average(self,frames):
+    sums = numpy.cumsum(frames,axis=0)
+    out = sums[self.length-1:].copy()
+    out[1:] -= sums[:-self.length]
+    out /= self.length
+    return out
+
+  def process(self,frames):
+    frames = numpy.concatenate([self.history,frames])
+    smooth = self.average(self.average(frames))
+    # smooth[i] is centred on frames[i+delay]
+    self.history = frames[len(smooth):]
+    return frames[self.delay:self.delay+len(smooth)] - smooth
+
+  def flush(self):
+    return self.process(numpy.zeros((self.delay,self.history.shape[1])))
+
+class Gain():
+  """
+  DSPChain stage with a fixed gain in dB
+  """
+  def __init__(self,channels,rate,dB):
+    self.factor = 10**(dB/20.)
+    self.setting = 'gain %gdB' % dB
+
+  def process(self,frames):
+    frames *= self.factor
+    return frames
+
+  def flush(self):
+    return None
+
+class SoftLimiter():
+  """
+  DSPChain stage passing levels up to threshold dBFS and bending
+  those above it along a tanh curve so they never reach full scale
+  """
+  def __init__(self,channels,rate,threshold):
+    self.threshold = 10**(threshold/20.)
+    self.setting = 'limit %gdBFS' % threshold
+
+  def process(self,frames):
+    over = numpy.abs(frames) > self.threshold
+    if over.any():
+      peaks = frames[over]
+      knee = 1. - self.threshold
+      frames[over] = numpy.sign(peaks)*(self.threshold + knee*
+        numpy.tanh((numpy.abs(peaks) - self.threshold)/knee))
+    return frames
+
+  def flush(self):
+    return None
+
+DSP_STAGES = {'highpass': HighPass, 'gain': Gain, 'limit': SoftLimiter}
+
+class DSPChain():
+  """
+  A writer filter running the frames as floats (full scale 1.0) through
+  the stages of chain (see DSP_CHAIN), a whole batch at a time in NumPy.
+  A stage has process(frames) returning the processed frames (in place
+  if it can) and flush() returning any frames it still holds or None.
+  """
+  def __init__(self,channels,sampleWidth,rate,chain):
+    if not numpy: raise RecordingError, 'NumPy is needed for the DSP chain'
+    if sampleWidth not in (2,4):
+      raise RecordingError, 'can not process %d byte samples' % sampleWidth
+    self.channels = channels
+    self.dtype = '<i%d' % sampleWidth
+    self.fullScale = float(2**(8*sampleWidth-1))
+    self.stages = []
+    for (stage,setting) in chain:
+      if stage not in DSP_STAGES: raise RecordingError, 'unknown DSP stage %s' % stage
+      self.stages.append(DSP_STAGES[stage](channels,rate,float(setting)))
+    self.settings = [stage.setting for stage in self.stages]
+
+  def process(self,data):
+    frames = asSamples(data,self.dtype).reshape(-1,self.channels)
+    return self.run(frames/self.fullScale,self.stages)
+
+  def flush(self):
+    out = []
+    for (i,stage) in enumerate(self.stages):
+      frames = stage.flush()
+      if frames is not None: out.append(self.run(frames,self.stages[i+1:]))
+    return ''.join(out)
+
+  def run(self,frames,stages):
+    for stage in stages: frames = stage.process(frames)
+    frames *= self.fullScale
+    numpy.around(frames,out=frames)
+    numpy.clip(frames,-self.fullScale,self.fullScale - 1,out=frames)
+    return frames.astype(self.dtype).tostring()
+
+class LevelMeter():
+  """
+  A writer output which measures peak, RMS, DC offset and clipped samples
+  of every buffer with NumPy.  Each buffer replaces the stats dictionary
+  as a whole, so stats() is a cheap, consistent snapshot for the display.
+  Levels are in dBFS, the DC offset is a fraction of full scale.
+  """
+  def __init__(self,sampleWidth):
+    if sampleWidth not in (2,4):
+      raise RecordingError, 'can not meter %d byte samples' % sampleWidth
+    self.dtype = '<i%d' % sampleWidth
+    self.fullScale = float(2**(8*sampleWidth-1))
+    self.clipLevel = int(CLIP_LEVEL*self.fullScale)
+    self.peakMax = 0
+    self.clipTotal = 0
+    self.buffers = 0
+    self.levels = {}
+
+  def writeframes(self,data):
+    samples = asSamples(data,self.dtype)
+    if not len(samples): return
+    peak = max(int(samples.max()),-int(samples.min()))
+    floats = samples.astype(numpy.float32)
+    rms = math.sqrt(float(numpy.dot(floats,floats))/len(floats))
+    clip = int(numpy.count_nonzero(samples >= self.clipLevel) +
+               numpy.count_nonzero(samples <= -self.clipLevel))
+    self.peakMax = max(self.peakMax,peak)
+    self.clipTotal += clip
+    self.buffers += 1
+    self.levels = {'peak': dBFS(peak/self.fullScale),
+                   'rms': dBFS(rms/self.fullScale),
+                   'dc': float(floats.mean())/self.fullScale,
+                   'clip': clip,
+                   'peakMax': dBFS(self.peakMax/self.fullScale),
+                   'clipTotal': self.clipTotal,
+                   'buffers': self.buffers}
+
+  def stats(self):
+    return self.levels
+
+  def close(self):
+    pass
+
+class PeakIndex():
+  """
+  A writer output which keeps the min and max of every PEAK_LEVELS[0]
+  frames of each channel as the buffers go by, and on close writes them
+  with the coarser levels made from them to the PEAKS_SIDECAR.  The
+  sidecar is one audiowaveform version 2 .dat (16 bit) for each level,
+  finest first, one after another, so the first is a .dat of its own.
+  peaks() is the finest level so far, to draw the recording as it goes.
+  """
+  def __init__(self,filename,channels,sampleWidth,rate,levels=PEAK_LEVELS):
+    if sampleWidth not in (2,4):
+      raise RecordingError, 'can not index %d byte samples' % sampleWidth
+    self.filename = os.path.splitext(filename)[0] + PEAKS_SIDECAR
+    self.channels = channels
+    self.rate = rate
+    self.levels = levels
+    self.dtype = '<i%d' % sampleWidth
+    # 32 bit samples are kept to 16 bits
+    self.shift = 8*sampleWidth - 16
+    self.pending = numpy.zeros((0,channels),self.dtype)
+    # arrays of (pixels,channels,2) min and max
+    self.blocks = []
+
+  def minMax(self,frames):
+    """
+    min and max of each PEAK_LEVELS[0] frames, the last may be short
+    """
+    size = self.levels[0]
+    pixels = -(-len(frames)//size)
+    if len(frames) % size:
+      frames = numpy.concatenate([frames,numpy.repeat(frames[-1:],
+                                  pixels*size - len(frames),axis=0)])
+    frames = frames.reshape(pixels,size,self.channels)
+    peaks = numpy.empty((pixels,self.channels,2),'<i2')
+    peaks[:,:,0] = frames.min(axis=1) >> self.shift
+    peaks[:,:,1] = frames.max(axis=1) >> self.shift
+    return peaks
+
+  def writeframes(self,data):
+    frames = asSamples(data,self.dtype).reshape(-1,self.channels)
+    if len(self.pending): frames = numpy.concatenate([self.pending,frames])
+    whole = len(frames) - len(frames) % self.levels[0]
+    if whole: self.blocks.append(self.minMax(frames[:whole]))
+    self.pending = frames[whole:].copy()
+
+  def peaks(self):
+    """
+    the finest level so far as an array of (pixels,channels,2)
+    """
+    if not self.blocks: return numpy.zeros((0,self.channels,2),'<i2')
+    if len(self.blocks) > 1: self.blocks = [numpy.concatenate(self.blocks)]
+    return self.blocks[0]
+
+  def close(self):
+    if not self.levels: return
+    if len(self.pending): self.blocks.append(self.minMax(self.pending))
+    peaks = self.peaks()
+    f = open(self.filename,'wb')
+    size = self.levels[0]
+    for level in self.levels:
+      if level != size:
+        # pixels of the level before grouped, the last group may be short
+        group = level//size
+        pixels = -(-len(peaks)//group)
+        padded = numpy.concatenate([peaks,numpy.repeat(peaks[-1:],
+                                    pixels*group - len(peaks),axis=0)])
+        padded = padded.reshape(pixels,group,self.channels,2)
+        peaks = numpy.empty((pixels,self.channels,2),'<i2')
+        peaks[:,:,0] = padded[:,:,:,0].min(axis=1)
+        peaks[:,:,1] = padded[:,:,:,1].max(axis=1)
+        size = level
+      f.write(struct.pack('<iIiiIi',2,0,self.rate,size,len(peaks),
+                          self.channels))
+      f.write(peaks.tostring())
+    f.close()
+    if DEBUG: print "peak index %s" % self.filename
+
+def readPeaks(filename):
+  """
+  return the levels of the peak index sidecar of a recording, finest
+  first, as dictionaries of rate, samplesPerPixel and peaks, an array of
+  (pixels,channels,2) min and max, or None if there is not one
+  """
+  sidecar = os.path.splitext(filename)[0] + PEAKS_SIDECAR
+  if not os.path.exists(sidecar): return None
+  f = open(sidecar,'rb')
+  data = f.read()
+  f.close()
+  levels = []
+  offset = 0
+  while offset < len(data):
+    (version,flags,rate,size,pixels,channels) = struct.unpack_from('<iIiiIi',
+                                                                 data,offset)
+    offset += 24
+    count = pixels*channels*2
+    peaks = numpy.frombuffer(data,'<i2',count,offset)
+    levels.append({'rate': rate,'samplesPerPixel': size,
+                   'peaks': peaks.reshape(pixels,channels,2)})
+    offset += 2*count
+  return levels
+
+class LiveServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class LiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """
+  Sends the recording to one listener as a WAV stream with chunked
+  transfer encoding, from its LiveStream queue, until the recording
+  closes or the listener goes away
+  """
+  protocol_version = 'HTTP/1.1'
+
+  def do_GET(self):
+    live = self.server.live
+    if self.path.split('?')[0] not in ('/','/live.wav'):
+      self.send_error(404)
+      return
+    client = live.connect()
+    try:
+      self.send_response(200)
+      self.send_header('Content-Type','audio/wav')
+      self.send_header('Transfer-Encoding','chunked')
+      self.send_header('Cache-Control','no-cache')
+      self.end_headers()
+      self.sendChunk(live.header())
+      data = client.get()
+      while data is not None:
+        self.sendChunk(data)
+        data = client.get()
+      self.wfile.write('0\r\n\r\n')
+      self.close_connection = 1
+    except socket.error:
+      if DEBUG: print "live listener %s:%d went away" % self.client_address
+    finally:
+      live.disconnect(client)
+
+  def sendChunk(self,data):
+    self.wfile.write('%x\r\n' % len(data))
+    self.wfile.write(data)
+    self.wfile.write('\r\n')
+    self.wfile.flush()
+
+  def log_message(self,format,*args):
+    if DEBUG: BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+class LiveStream():
+  """
+  A writer output serving the frames on port to any number of HTTP
+  listeners (http://host:port/live.wav).  Every batch is copied once and
+  put on each listener's queue of LIVE_CLIENT_BATCHES, a listener too
+  slow to keep up has batches dropped instead of holding up the writer.
+  """
+  def __init__(self,port,channels,sampleWidth,rate):
+    self.channels = channels
+    self.sampleWidth = sampleWidth
+    self.rate = rate
+    self.clients = []
+    self.lock = threading.Lock()
+    self.dropped = 0
+    self.listeners = 0
+    self.server = LiveServer((LIVE_ADDRESS,port),LiveHandler)
+    self.server.live = self
+    self.port = self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    if DEBUG: print "serving live on port %d" % self.port
+
+  def header(self):
+    """
+    a wave header for a stream of unknown length
+    """
+    return waveHeader(self.channels,self.sampleWidth,self.rate,RIFF_LIMIT)
+
+  def connect(self):
+    client = Queue.Queue(LIVE_CLIENT_BATCHES)
+    self.lock.acquire()
+    self.clients.append(client)
+    self.listeners += 1
+    self.lock.release()
+    return client
+
+  def disconnect(self,client):
+    self.lock.acquire()
+    if client in self.clients: self.clients.remove(client)
+    self.lock.release()
+
+  def writeframes(self,data):
+    if not self.clients: return
+    if isinstance(data,memoryview): data = data.tobytes()
+    else: data = str(data)
+    self.lock.acquire()
+    clients = list(self.clients)
+    self.lock.release()
+    for client in clients:
+      try:
+        client.put_nowait(data)
+      except Queue.Full:
+        self.dropped += 1
+
+  def stats(self):
+    return {'port': self.port,
+            'clients': len(self.clients),
+            'listeners': self.listeners,
+            'dropped': self.dropped}
+
+  def close(self):
+    """
+    end every listener's stream and stop serving
+    """
+    self.lock.acquire()
+    clients = list(self.clients)
+    self.lock.release()
+    for client in clients:
+      # make room for the end of the stream if it has to be
+      try:
+        client.get_nowait()
+      except Queue.Empty:
+        pass
+      client.put(None)
+    self.server.shutdown()
+    self.server.server_close()
+
+def silenceSidecar(filename):
+  """
+  name of the silence sidecar for a recording
+  """
+  return os.path.splitext(filename)[0] + SILENCE_SIDECAR
+
+def readSilence(filename):
+  """
+  return the silence sidecar of a recording as a dictionary
+  (see SilenceDetector.result()) or None if there is not one
+  """
+  sidecar = silenceSidecar(filename)
+  if not os.path.exists(sidecar): return None
+  f = open(sidecar,'r')
+  silence = yaml.safe_load(f)
+  f.close()
+  return silence
+
+class SilenceDetector():
+  """
+  A writer output which finds the silence in a recording from the RMS
+  level of SILENCE_WINDOW_SECONDS windows.  At close() the trim points
+  (first and last sound), the silent stretches and the regions worth
+  keeping are written to a YAML sidecar next to the recording so the
+  converter can use them and the decision can be checked later.
+  All positions are frame numbers from the start of the recording.
+  """
+  def __init__(self,filename,channels,sampleWidth,rate):
+    self.sidecar = silenceSidecar(filename)
+    self.dtype = '<i%d' % sampleWidth
+    self.channels = channels
+    self.rate = rate
+    self.threshold = 2**(8*sampleWidth-1)*10**(SILENCE_LEVEL/20.)
+    self.windowFrames = int(SILENCE_WINDOW_SECONDS*rate)
+    self.windowSamples = self.windowFrames*channels
+    self.minFrames = int(SILENCE_MIN_SECONDS*rate)
+    # samples of the window still being filled
+    self.pending = numpy.zeros(self.windowSamples,dtype=self.dtype)
+    self.pendingFill = 0
+    # frames in complete windows so far
+    self.frames = 0
+    self.firstSound = None
+    self.lastSound = None
+    # start of the current silent stretch, None while there is sound
+    self.silentStart = 0
+    self.silent = []
+
+  def writeframes(self,data):
+    samples = asSamples(data,self.dtype)
+    # finish the window left over from the last buffer
+    if self.pendingFill:
+      n = min(len(samples),self.windowSamples - self.pendingFill)
+      self.pending[self.pendingFill:self.pendingFill+n] = samples[:n]
+      self.pendingFill += n
+      samples = samples[n:]
+      if self.pendingFill == self.windowSamples:
+        self.analyse(self.pending.reshape(1,-1))
+        self.pendingFill = 0
+    whole = len(samples)//self.windowSamples*self.windowSamples
+    if whole: self.analyse(samples[:whole].reshape(-1,self.windowSamples))
+    rest = samples[whole:]
+    self.pending[:len(rest)] = rest
+    self.pendingFill += len(rest)
+
+  def analyse(self,windows):
+    """
+    classify a 2D array of whole windows, one window per row
+    """
+    floats = windows.astype(numpy.float32)
+    loud = numpy.sqrt((floats*floats).mean(axis=1)) >= self.threshold
+    for isLoud in loud:
+      if isLoud:
+        if self.firstSound is None: self.firstSound = self.frames
+        if self.silentStart is not None: self.endSilence(self.frames)
+        self.lastSound = self.frames + self.windowFrames
+      elif self.silentStart is None:
+        self.silentStart = self.frames
+      self.frames += self.windowFrames
+
+  def endSilence(self,frame):
+    if frame - self.silentStart >= self.minFrames:
+      self.silent.append([self.silentStart,frame])
+    self.silentStart = None
+
+  def result(self):
+    """
+    dictionary of
+      rate, frames and level (dBFS) the detection was done with
+      silent: [start,end] of every silent stretch
+      trim: [start,end] from the first to the last sound (with padding)
+      keep: [start,end] regions of trim less the long silent stretches
+    a recording with no sound at all is kept whole
+    """
+    pad = int(SILENCE_PAD_SECONDS*self.rate)
+    if self.firstSound is None: trim = [0,self.frames]
+    else: trim = [max(0,self.firstSound - pad),
+                  min(self.frames,self.lastSound + pad)]
+    keep = []
+    start = trim[0]
+    for (silentStart,silentEnd) in self.silent:
+      if (silentEnd - silentStart < SILENCE_SKIP_SECONDS*self.rate or
+          silentStart <= trim[0] or silentEnd >= trim[1]): continue
+      keep.append([start,silentStart + pad])
+      start = silentEnd - pad
+    keep.append([start,trim[1]])
+    return {'rate': self.rate,
+            'frames': self.frames,
+            'level': SILENCE_LEVEL,
+            'silent': self.silent,
+            'trim': trim,
+            'keep': keep}
+
+  def close(self):
+    # the part window counts the same as the one before it
+    self.frames += self.pendingFill//self.channels
+    self.pendingFill = 0
+    if self.silentStart is not None: self.endSilence(self.frames)
+    f = open(self.sidecar,'w')
+    yaml.safe_dump(self.result(),f,default_flow_style=False)
+    f.close()
+    if DEBUG: print "silence sidecar %s" % self.sidecar
+
+class SafeWave():
+  """
+  A wave file output that takes the same writeframes() and close() calls
+  as a wave.Wave_write, but
+    preallocates expectedBytes of frame data on disk,
+    coalesces writes into WAVE_BLOCK_BYTES blocks aligned on the file,
+    rewrites the header every WAVE_CHECKPOINT_SECONDS,
+    fsyncs as set by WAVE_FSYNC and
+    becomes RF64 past RIFF_LIMIT, as set by WAVE_RF64
+  so after a power cut the file is playable up to the last checkpoint.
+  """
+  def __init__(self,filename,channels,sampleWidth,rate,expectedBytes=0):
+    self.filename = filename
+    self.channels = channels
+    self.sampleWidth = sampleWidth
+    self.rate = rate
+    self.dataBytes = 0
+    self.headerBytes = WAVE_HEADER_BYTES
+    if (WAVE_RF64 == 'always' or (WAVE_RF64 == 'auto' and
+        WAVE_HEADER_BYTES + expectedBytes - 8 > RIFF_LIMIT)):
+      self.headerBytes = RF64_HEADER_BYTES
+    self.fd = os.open(filename,os.O_RDWR|os.O_CREAT|os.O_TRUNC,0644)
+    if expectedBytes:
+      self.preallocated = preallocate(self.fd,self.headerBytes+expectedBytes)
+    else: self.preallocated = False
+    # the block being filled covers the file from blockOffset,
+    # the first one starts with the header
+    self.block = bytearray(WAVE_BLOCK_BYTES)
+    self.view = memoryview(self.block)
+    self.blockOffset = 0
+    self.blockFill = self.headerBytes
+    self.view[0:self.headerBytes] = self.header()
+    self.checkpointTime = time.time()
+    self.started = self.checkpointTime
+    self.sha1 = audioHash(channels,sampleWidth,rate)
+    self.checkpoint()
+
+  def header(self):
+    return headerFor(self.headerBytes,self.channels,self.sampleWidth,
+                     self.rate,self.dataBytes)
+
+  def writeBlock(self):
+    """
+    write the current block, full or not, at its aligned offset
+    """
+    os.lseek(self.fd,self.blockOffset,os.SEEK_SET)
+    os.write(self.fd,self.view[0:self.blockFill])
+    if WAVE_FSYNC == 'always': os.fsync(self.fd)
+
+  def filled(self,n):
+    """
+    account for n more bytes put in the block, writing it once it is full
+    """
+    self.sha1.update(self.view[self.blockFill:self.blockFill+n])
+    self.blockFill += n
+    self.dataBytes += n
+    if self.blockFill == WAVE_BLOCK_BYTES:
+      self.writeBlock()
+      self.blockOffset += WAVE_BLOCK_BYTES
+      self.blockFill = 0
+
+  def writeframes(self,data):
+    view = memoryview(data)
+    while len(view):
+      n = min(len(view),WAVE_BLOCK_BYTES - self.blockFill)
+      self.view[self.blockFill:self.blockFill+n] = view[:n]
+      view = view[n:]
+      self.filled(n)
+    if time.time() - self.checkpointTime >= WAVE_CHECKPOINT_SECONDS:
+      self.checkpoint()
+
+  def writeSamples(self,samples):
+    """
+    like writeframes() but for a NumPy array of samples that does not
+    need to be contiguous, such as one channel of interleaved frames,
+    it is copied straight into the block
+    """
+    blockSamples = numpy.frombuffer(self.block,dtype=samples.dtype)
+    size = samples.itemsize
+    i = 0
+    while i < len(samples):
+      start = self.blockFill//size
+      n = min(len(samples) - i,len(blockSamples) - start)
+      blockSamples[start:start+n] = samples[i:i+n]
+      i += n
+      self.filled(n*size)
+    if time.time() - self.checkpointTime >= WAVE_CHECKPOINT_SECONDS:
+      self.checkpoint()
+
+  def checkpoint(self):
+    """
+    put the partial block on disk (it is rewritten in place when it fills)
+    and rewrite the header to cover everything written so far
+    """
+    self.writeBlock()
+    os.lseek(self.fd,0,os.SEEK_SET)
+    os.write(self.fd,self.header())
+    if WAVE_FSYNC in ('checkpoint','always'): os.fsync(self.fd)
+    self.journal()
+    self.checkpointTime = time.time()
+    if DEBUG > 1: print "checkpoint %s at %d bytes" % (self.filename,self.dataBytes)
+
+  def close(self):
+    """
+    write what is left, drop any unused preallocated space
+    and write the final header
+    """
+    self.checkpoint()
+    os.ftruncate(self.fd,self.headerBytes+self.dataBytes)
+    os.fsync(self.fd)
+    os.close(self.fd)
+    self.fd = None
+    s = os.stat(self.filename)
+    f = open(hashSidecar(self.filename),'w')
+    yaml.safe_dump({'sha1': self.sha1.hexdigest(),
+                    'size': s.st_size,
+                    'mtime': int(s.st_mtime)},
+                   f,default_flow_style=False)
+    f.close()
+    os.remove(journalSidecar(self.filename))
+
+  def journal(self):
+    """
+    replace the journal with the format and frames written so far
+    """
+    sidecar = journalSidecar(self.filename)
+    f = open(sidecar + '.tmp','w')
+    yaml.safe_dump({'filename': self.filename,
+                    'channels': self.channels,
+                    'sampleWidth': self.sampleWidth,
+                    'rate': self.rate,
+                    'headerBytes': self.headerBytes,
+                    'frames': self.dataBytes//(self.channels*self.sampleWidth),
+                    'started': self.started,
+                    'updated': time.time()},
+                   f,default_flow_style=False)
+    f.flush()
+    if WAVE_FSYNC in ('checkpoint','always'): os.fsync(f.fileno())
+    f.close()
+    os.rename(sidecar + '.tmp',sidecar)
+
+def journalSidecar(filename):
+  return os.path.splitext(filename)[0] + JOURNAL_SIDECAR
+
+def hashSidecar(filename):
+  return os.path.splitext(filename)[0] + HASH_SIDECAR
+
+def audioHash(channels,sampleWidth,rate):
+  """
+  a SHA-1 for the frame data of a wave file of this format, updated
+  with the data it is the same as STELC_Cache.fileHash() of the file
+  """
+  return hashlib.sha1('%d %d %d ' % (channels,sampleWidth,rate))
+
+def readHash(filename):
+  """
+  the SHA-1 of the audio of filename worked out while it was recorded,
+  None if there is none or the file has changed since
+  """
+  sidecar = hashSidecar(filename)
+  if not os.path.exists(sidecar): return None
+  f = open(sidecar)
+  stored = yaml.safe_load(f) or {}
+  f.close()
+  s = os.stat(filename)
+  if stored.get('size') != s.st_size or stored.get('mtime') != int(s.st_mtime):
+    return None
+  return stored.get('sha1')
+
+def isSidecar(filename):
+  return filename.endswith(SIDECARS)
+
+def sidecars(filename):
+  """
+  the sidecars there are next to the recording filename
+  """
+  base = os.path.splitext(filename)[0]
+  return [base + sidecar for sidecar in SIDECARS
+          if os.path.exists(base + sidecar)]
+
+def repairWave(filename,journal):
+  """
+  fix the header of a wave file left behind by a SafeWave, in place,
+  from its journal and return the bytes of frame data it now holds.
+  Blocks can have been written after the last checkpoint, so the data
+  is taken to end at the last non zero byte up to a ring buffer and a
+  checkpoint beyond the journal (past that is unwritten preallocation),
+  which is then cut off the file.
+  """
+  frameSize = journal['channels']*journal['sampleWidth']
+  headerBytes = journal.get('headerBytes',WAVE_HEADER_BYTES)
+  start = headerBytes + journal['frames']*frameSize
+  limit = (journal['rate']*frameSize*
+           (WAVE_CHECKPOINT_SECONDS + RING_BUFFER_SECONDS + WRITE_BATCH_DELAY))
+  fd = os.open(filename,os.O_RDWR)
+  end = min(os.fstat(fd).st_size,start + int(limit))
+  # scan back a block at a time for the end of the data
+  dataEnd = start
+  while end > start:
+    blockStart = max(start,end - WAVE_BLOCK_BYTES)
+    os.lseek(fd,blockStart,os.SEEK_SET)
+    block = os.read(fd,end - blockStart).rstrip('\0')
+    if block:
+      dataEnd = blockStart + len(block)
+      break
+    end = blockStart
+  dataBytes = dataEnd - headerBytes
+  # whole frames only, a partial frame at the end is padded out
+  dataBytes += -dataBytes % frameSize
+  os.lseek(fd,0,os.SEEK_SET)
+  os.write(fd,headerFor(headerBytes,journal['channels'],journal['sampleWidth'],
+                        journal['rate'],dataBytes))
+  os.ftruncate(fd,headerBytes + dataBytes)
+  os.fsync(fd)
+  os.close(fd)
+  return dataBytes
+
+def recoverWaves(directory='.'):
+  """
+  repair every wave file in directory left with a journal and return
+  their filenames, call this before recording (a file being written
+  has a journal too)
+  """
+  recovered = []
+  for sidecar in sorted(glob.glob(os.path.join(directory,'*' + JOURNAL_SIDECAR))):
+    f = open(sidecar)
+    try:
+      journal = yaml.safe_load(f)
+    finally:
+      f.close()
+    filename = journal and os.path.normpath(os.path.join(
+      os.path.dirname(sidecar),os.path.basename(journal['filename'])))
+    if filename and os.path.exists(filename):
+      dataBytes = repairWave(filename,journal)
+      if DEBUG: print "recovered %s with %d bytes" % (filename,dataBytes)
+      recovered.append(filename)
+    os.remove(sidecar)
+  return recovered
+
+class ChannelSplitter():
+  """
+  A writer output which de-interleaves the frames into one mono SafeWave
+  per channel, named with CHANNEL_FORMAT.  Each channel is a strided
+  NumPy view of the buffer copied straight into its file's write block,
+  so there are no copies of the frames in between.
+  """
+  def __init__(self,filename,channels,sampleWidth,rate,expectedBytes=0):
+    if not numpy: raise RecordingError, 'NumPy is needed to split channels'
+    if sampleWidth not in (2,4):
+      raise RecordingError, 'can not split %d byte samples' % sampleWidth
+    base,ext = os.path.splitext(filename)
+    self.dtype = '<i%d' % sampleWidth
+    self.channels = channels
+    self.filenames = [base + CHANNEL_FORMAT % (c+1) + ext
+                      for c in range(channels)]
+    self.waves = [SafeWave(fn,1,sampleWidth,rate,expectedBytes//channels)
+                  for fn in self.filenames]
+
+  def writeframes(self,data):
+    frames = asSamples(data,self.dtype).reshape(-1,self.channels)
+    for c in range(self.channels): self.waves[c].writeSamples(frames[:,c])
+
+  def close(self):
+    for wave in self.waves: wave.close()
+
+class SegmentedWave():
+  """
+  A wave file output which rotates to a new numbered file every
+  segmentSeconds of audio or segmentBytes of frame data, whichever
+  comes first (0 means no limit).  Buffers are split on the exact
+  boundary frame so nothing is dropped between segments.
+  Functions added with subscribe() are called as fn(filename,number,last)
+  from the writer thread every time a segment is closed, last is True
+  only for the segment closed by close() at the end of the recording.
+  """
+  def __init__(self,waveFilename,channels,sampleWidth,rate,
+               segmentSeconds=0,segmentBytes=0):
+    base,ext = os.path.splitext(waveFilename)
+    self.filenameFormat = base + SEGMENT_FORMAT + ext
+    self.channels = channels
+    self.sampleWidth = sampleWidth
+    self.rate = rate
+    self.frameSize = channels*sampleWidth
+    limits = []
+    if segmentSeconds: limits.append(int(segmentSeconds*rate))
+    if segmentBytes: limits.append(int(segmentBytes)//self.frameSize)
+    if not limits or min(limits) < 1:
+      raise RecordingError, 'segments need a positive length'
+    self.segmentFrames = min(limits)
+    self.listeners = []
+    # filenames of the closed segments
+    self.segments = []
+    self.number = 0
+    self.filename = None
+    self.wf = None
+    self.framesInSegment = 0
+
+  def subscribe(self,fn):
+    self.listeners.append(fn)
+
+  def openSegment(self):
+    self.number += 1
+    self.filename = self.filenameFormat % self.number
+    self.wf = SafeWave(self.filename,self.channels,self.sampleWidth,self.rate,
+                       self.segmentFrames*self.frameSize)
+    self.framesInSegment = 0
+
+  def closeSegment(self,last=False):
+    self.wf.close()
+    self.wf = None
+    self.segments.append(self.filename)
+    if DEBUG: print "segment %d closed %s" % (self.number,self.filename)
+    for fn in self.listeners: fn(self.filename,self.number,last)
+
+  def writeframes(self,data):
+    view = memoryview(data)
+    while len(view):
+      # a full segment is only closed once there is more to write so
+      # that the segment closed by close() is always the last one
+      if self.wf and self.framesInSegment >= self.segmentFrames:
+        self.closeSegment()
+      if not self.wf: self.openSegment()
+      room = (self.segmentFrames - self.framesInSegment)*self.frameSize
+      part = view[:room]
+      self.wf.writeframes(part)
+      self.framesInSegment += len(part)//self.frameSize
+      view = view[len(part):]
+
+  def close(self):
+    if self.wf: self.closeSegment(last=True)
+
+class StreamEncoder():
+  """
+  An output which pipes the recorded frames to an ENCODER process so
+  the compressed file is complete as soon as the recording stops.
+  The frames are fed to it from a queue of ENCODER_BATCHES by its own
+  thread, so a slow encoder never holds up the writer.  If the encoder
+  dies or falls behind the recording carries on without it and failed
+  is set, so the caller can fall back to converting the wav afterwards.
+  """
+  def __init__(self,filename,channels,sampleWidth,rate):
+    self.filename = filename
+    self.failed = False
+    self.returncode = None
+    self.dropped = 0
+    self.queue = Queue.Queue(ENCODER_BATCHES)
+    cmd = ENCODER % {'rate': rate,
+                     'bits': 8*sampleWidth,
+                     'channels': channels,
+                     'filename': filename}
+    if DEBUG: print "encode command: %s" % cmd
+    self.log = open(ENCODER_LOG,'w')
+    self.pipe = subprocess.Popen(shlex.split(cmd),
+      bufsize=-1,
+      stdin=subprocess.PIPE,
+      stdout=self.log,
+      stderr=self.log,
+      close_fds=True)
+    self.thread = threading.Thread(target=self.feed)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def feed(self):
+    """
+    write the queued batches to the encoder until close() queues None
+    """
+    while True:
+      data = self.queue.get()
+      if data is None: break
+      if self.failed: continue
+      try:
+        self.pipe.stdin.write(data)
+      except IOError:
+        self.failed = True
+        if DEBUG: print "encoder for %s died" % self.filename
+    try: self.pipe.stdin.close()
+    except IOError: self.failed = True
+
+  def writeframes(self,data):
+    if self.failed: return
+    if isinstance(data,memoryview): data = data.tobytes()
+    else: data = str(data)
+    try:
+      self.queue.put_nowait(data)
+    except Queue.Full:
+      # the encoded file would have a gap, give up on it
+      self.dropped += 1
+      self.failed = True
+      if DEBUG: print "encoder for %s fell behind" % self.filename
+
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
+    self.returncode = self.pipe.wait()
+    if self.returncode: self.failed = True
+    self.log.close()
+    if DEBUG: print "encoder done %s" % self.returncode
+
+class PyAudioSource():
+  """
+  The PortAudio input a Record opens its stream on, the default input
+  device unless deviceIndex is given.  Other sources (see STELC_Simulator)
+  only need the same open(), terminate(), deviceIndex and name.
+  """
+  def __init__(self,deviceIndex=None,p=None):
+    # initialize PortAudio unless sharing an instance
+    self.ownP = p is None
+    if self.ownP: p = pyaudio.PyAudio()
+    self.p = p
+    # det default recording device
+    if deviceIndex is None:
+      deviceIndex = self.p.get_default_input_device_info()['index']
+    self.deviceIndex = deviceIndex
+    self.name = self.p.get_device_info_by_index(deviceIndex)['name']
+    # set when other sources use this one's PortAudio instance
+    self.shared = False
+
+  def open(self,inputFormat,channels,rate,framesPerBuffer,callback):
+    """
+    open a stream, but do not start it
+    """
+    return self.p.open(format=inputFormat,
+                       channels=channels,
+                       rate=rate,
+                       input=True,
+                       start=False,
+                       input_device_index=self.deviceIndex,
+                       frames_per_buffer=framesPerBuffer,
+                       stream_callback=callback)
+
+  def reset(self):
+    """
+    start PortAudio over so a device that went away and came back is
+    found again, by name as its index can change (not possible while
+    other sources share the instance, then the same index is tried)
+    """
+    if not self.ownP or self.shared: return
+    self.p.terminate()
+    self.p = pyaudio.PyAudio()
+    for i in range(self.p.get_device_count()):
+      info = self.p.get_device_info_by_index(i)
+      if info['name'] == self.name and info['maxInputChannels'] > 0:
+        self.deviceIndex = i
+        return
+    raise RecordingError, 'can not find %s' % self.name
+
+  def terminate(self):
+    if self.ownP: self.p.terminate()
+
+def readCalibration():
+  """
+  return the calibration file as a dictionary, empty if there is none
+  """
+  if not os.path.exists(CALIBRATION_FILENAME): return {}
+  f = open(CALIBRATION_FILENAME,'r')
+  calibration = yaml.safe_load(f) or {}
+  f.close()
+  return calibration
+
+def calibrationKey(deviceName,rate):
+  return "%s@%d" % (deviceName,rate)
+
+def loadCalibration(deviceName,rate):
+  """
+  return the calibrated chunk for a device and rate, or None
+  """
+  entry = readCalibration().get(calibrationKey(deviceName,rate))
+  if entry: return entry['chunk']
+  return None
+
+def calibrate(source=None,seconds=CALIBRATION_SECONDS,chunks=CALIBRATION_CHUNKS):
+  """
+  record seconds from source (the default input if None) with each of
+  the chunks as frames_per_buffer and measure overflows, dropped buffers
+  and callback jitter.  The best is the smallest chunk without overflows
+  or drops whose worst callback interval is within
+  CALIBRATION_JITTER_LIMIT of the buffer period, failing that the one with
+  the fewest problems.  It is saved to CALIBRATION_FILENAME and returned.
+  """
+  ownSource = source is None
+  if ownSource: source = PyAudioSource()
+  directory = tempfile.mkdtemp(prefix='STELC_calibrate_')
+  results = {}
+  try:
+    for chunk in chunks:
+      r = Record(recordSeconds=seconds,
+                 waveFilename=os.path.join(directory,'calibrate.wav'),
+                 source=source,chunk=chunk)
+      r.start()
+      while r.stream.is_active():
+        time.sleep(0.1)
+      r.stop()
+      stats = r.callbackStats()
+      period = float(chunk)/r.samplingRate
+      results[chunk] = {
+        'overflows': stats['errors']['InputOverflow'],
+        'drops': r.bufferStats()['droppedBuffers'],
+        'jitter': max(0.,stats['interval']['max'] - period)/period}
+      del r
+      if DEBUG: print "calibrate chunk %d %s" % (chunk,results[chunk])
+  finally:
+    shutil.rmtree(directory)
+    if ownSource: source.terminate()
+  best = min(chunks,key=lambda c:(results[c]['overflows'] + results[c]['drops'],
+                                  results[c]['jitter'] > CALIBRATION_JITTER_LIMIT,
+                                  c))
+  calibration = readCalibration()
+  calibration[calibrationKey(source.name,Record.samplingRate)] = {
+    'chunk': best,
+    'time': time.ctime(),
+    'results': results}
+  f = open(CALIBRATION_FILENAME,'w')
+  yaml.safe_dump(calibration,f,default_flow_style=False)
+  f.close()
+  if DEBUG: print "calibrated chunk %d for %s" % (best,source.name)
+  return best
+
 class Record:
   """
   Instantiating this class opens a new stream and WAV filename
@@ -56,9 +1644,11 @@ class Record:
   to enable realtime permissions.
   """
   # 65536 correspondes to about 1.3 sec between callbacks
-  # but is also helps to minimize Input Overflows
-  chunk = 65536
-  #chunk = 1024
+  # and was needed to minimize Input Overflows while the callback
+  # wrote to the SD card.  Now the callback only copies into the ring
+  # buffer so a much shorter period (about 0.17 sec) is fine.
+  #chunk = 65536
+  chunk = 8192
   inputFormat = INPUT_FORMAT
   inputChannels = INPUT_CHANNELS
   samplingRate = SAMPLING_RATE
@@ -68,17 +1658,41 @@ class Record:
                    'OutputOverflow':0,
                    'PrimingOutput':0}
 
-  def __init__(self,recordSeconds=SECONDS,waveFilename="test_rec.wav",blocking=False):
+  def __init__(self,recordSeconds=SECONDS,waveFilename="test_rec.wav",blocking=False,
+               segmentSeconds=0,segmentBytes=0,encodeFilename=None,keepWave=True,
+               expectedBytes=0,source=None,chunk=None,channels=None,
+               splitChannels=False,storeRate=None,dsp=None,livePort=None):
     """
     load PyAudio, create stream, and open wav file
     takes recordSeconds for the recording length
     and waveFilename for the wav file which will be opened
     default is to run in callback mode, blocking mode does not currently work
+    segmentSeconds or segmentBytes split the recording into numbered
+    wav files of that length instead of one file (see SegmentedWave)
+    encodeFilename is compressed while recording (see StreamEncoder),
+    in which case keepWave=False skips writing the wav file at all
+    expectedBytes is preallocated for the wav file (see SafeWave)
+    source is where to record from, a new PyAudioSource by default
+    chunk overrides the frames per buffer, otherwise the one found by
+    calibrate() for the device is used, or Record.chunk if there is none
+    channels overrides the number of input channels (Record.inputChannels)
+    splitChannels also writes a mono wav file per channel (see ChannelSplitter)
+    storeRate is the rate written to the files, STORE_RATE by default,
+    expectedBytes and segmentBytes are at this rate (see Resampler)
+    dsp is the processing applied before writing, DSP_CHAIN by default
+    livePort serves the recording live over HTTP, LIVE_PORT by default
     """
-    # initialize PortAudio
-    self.p = pyaudio.PyAudio()
-    # det default recording device
-    self.devIndex = self.p.get_default_input_device_info()['index']
+    if channels: self.inputChannels = channels
+    # a source passed in is left for the caller to terminate
+    self.ownSource = source is None
+    if self.ownSource: source = PyAudioSource()
+    self.source = source
+    self.devIndex = self.source.deviceIndex
+    if not chunk: chunk = loadCalibration(self.source.name,self.samplingRate)
+    if chunk: self.chunk = chunk
+    self.sampleSize = pyaudio.get_sample_size(self.inputFormat)
+    # counts are per recording
+    self.errorCounter = dict.fromkeys(Record.errorCounter.keys(),0)
     # set callback or None for blocking mode
     # blocking mode does not work at this time
     self.blocking = blocking
@@ -86,65 +1700,238 @@ class Record:
     # set wave filename and recording time
     self.waveFilename = waveFilename
     self.recordSeconds = recordSeconds
+    self.storeRate = storeRate or STORE_RATE or self.samplingRate
     # open the stream, but do not start it
-    self.stream = self.p.open(format=self.inputFormat,
-                              channels=self.inputChannels,
-                              rate=self.samplingRate,
-                              input=True,
-                              start=False,
-                              input_device_index=self.devIndex,
-                              frames_per_buffer=self.chunk,
-                              stream_callback=callback)
-
-    # open wave file
-    self.wf = wave.open(self.waveFilename, 'wb')
-    self.wf.setnchannels(self.inputChannels)
-    self.wf.setsampwidth(self.p.get_sample_size(self.inputFormat))
-    self.wf.setframerate(self.samplingRate)
+    self.stream = self.source.open(self.inputFormat,self.inputChannels,
+                                   self.samplingRate,self.chunk,callback)
+
+    if not keepWave and not encodeFilename and not splitChannels:
+      raise RecordingError, 'nothing to record to without a wave or encode file'
+    self.outputs = []
+    # serve live listeners ahead of the slower outputs
+    self.live = None
+    if livePort is None: livePort = LIVE_PORT
+    if livePort:
+      self.live = LiveStream(livePort,self.inputChannels,self.sampleSize,
+                             self.storeRate)
+      self.outputs.append(self.live)
+    # open wave file, or the segmented wave files
+    self.segmented = keepWave and bool(segmentSeconds or segmentBytes)
+    if not keepWave:
+      self.wf = None
+    elif self.segmented:
+      self.wf = SegmentedWave(self.waveFilename,self.inputChannels,
+                              self.sampleSize,
+                              self.storeRate,segmentSeconds,segmentBytes)
+    else:
+      self.wf = SafeWave(self.waveFilename,self.inputChannels,
+                         self.sampleSize,
+                         self.storeRate,expectedBytes)
+    if self.wf: self.outputs.append(self.wf)
+    self.splitter = None
+    if splitChannels and self.inputChannels > 1:
+      self.splitter = ChannelSplitter(self.waveFilename,self.inputChannels,
+                                      self.sampleSize,self.storeRate,
+                                      expectedBytes)
+      self.outputs.append(self.splitter)
+    # start the encoder on the same frames
+    self.encodeFilename = encodeFilename
+    self.encoder = None
+    if self.encodeFilename:
+      self.encoder = StreamEncoder(self.encodeFilename,self.inputChannels,
+                                   self.sampleSize,
+                                   self.storeRate)
+      self.outputs.append(self.encoder)
+    # measure levels and find silence in the writer thread, the levels
+    # of the input as captured so the DSP (a limiter) does not hide clipping
+    self.taps = []
+    self.meter = None
+    self.silence = None
+    self.peakIndex = None
+    if numpy:
+      self.meter = LevelMeter(self.sampleSize)
+      self.taps.append(self.meter)
+      self.silence = SilenceDetector(self.waveFilename,self.inputChannels,
+                                     self.sampleSize,
+                                     self.storeRate)
+      self.outputs.append(self.silence)
+      if PEAK_LEVELS:
+        self.peakIndex = PeakIndex(self.waveFilename,self.inputChannels,
+                                   self.sampleSize,self.storeRate)
+        self.outputs.append(self.peakIndex)
+    # the callback copies into the ring buffer, the writer thread
+    # drains it to the outputs
+    frameSize = self.inputChannels*self.sampleSize
+    self.ring = RingBuffer(frameSize*self.samplingRate*RING_BUFFER_SECONDS)
+    self.filters = []
+    if self.storeRate != self.samplingRate:
+      self.filters.append(Resampler(self.inputChannels,self.sampleSize,
+                                    self.samplingRate,self.storeRate))
+    self.dsp = None
+    if dsp is None: dsp = DSP_CHAIN
+    if dsp:
+      self.dsp = DSPChain(self.inputChannels,self.sampleSize,
+                          self.storeRate,dsp)
+      self.filters.append(self.dsp)
+    self.writer = Writer(self.ring,self.outputs,self.filters,self.taps)
+    if self.live: self.writer.batchDelay = LIVE_BATCH_DELAY
+    self.stats = CallbackStats(frameSize*self.samplingRate)
     # set tracking flags
-    self.endStreamTime = 0
+    self.framesLeft = 0
     self.timeLeft = 0
     self.isStarted = False
     self.isPaused = False
     self.isStopped = False
+    # set by preroll(), the buffer is handed to the writer by the
+    # first callback after start()
+    self.isPrerolling = False
+    self.prerollBuffer = None
+    # set by arm(), the stream time of the first frame to record
+    # (cleared by the callback once it is reached) and whether the
+    # recording was armed, which start() then leaves to the callback
+    self.armStreamTime = None
+    self.isArmed = False
+    # frames handed to the writer, and the silence put in for frames
+    # the device lost as (frame,frames) at the capture rate, see gapList()
+    self.framesCommitted = 0
+    self.gaps = []
+    # frames lost (by the device or to a full ring buffer) still to be
+    # put in as silence, see fillLost()
+    self.lostFrames = 0
+    self.nextAdcTime = None
+    # wall clock time of the last callback and of the expected end of
+    # the recording, for reopening a stream that died (see Session)
+    self.lastCallbackTime = None
+    self.endTime = None
+    self.reconnected = False
+    self.reconnects = 0
     
   def callback(self, in_data, frame_count, time_info, status):
     """
     callback for pyaudio stream
     """
-    # print timing data
-    if DEBUG:
-      print "%6d frames, %9.3fs adc in, %9.3fs now, %9.3fs dac out" %(
-        frame_count,time_info['input_buffer_adc_time'],
-        time_info['current_time'],time_info['output_buffer_dac_time'])
+    # keep timing stats, printing here would delay the stream
+    self.stats.update(frame_count,time_info,self.ring)
     # log errors by type
     if status & pyaudio.paInputUnderflow: self.errorCounter['InputUnderflow'] += 1
     if status & pyaudio.paInputOverflow: self.errorCounter['InputOverflow'] += 1
     if status & pyaudio.paOutputUnderflow: self.errorCounter['OutputUnderflow'] += 1
     if status & pyaudio.paOutputOverflow: self.errorCounter['OutputOverflow'] += 1
     if status & pyaudio.paPrimingOutput: self.errorCounter['PrimingOutput'] += 1
-    # set time left
-    self.timeLeft = self.endStreamTime-time_info['current_time']
-    # print staus and time left
-    if DEBUG: print "status = %d, %fs left, start->%s, pause->%s, stop->%s" % (
-      status,self.timeLeft,self.isStarted,self.isPaused,self.isStopped)
+    frameSize = self.inputChannels*self.sampleSize
+    data = memoryview(in_data)
+    # frames the device lost since the last buffer (a gap inside the
+    # preroll or before an armed start is not filled)
+    missing = self.missingFrames(frame_count,time_info,status)
+    if self.isPrerolling: missing = 0
+    # keep the most recent audio until the recording starts
+    if self.isPrerolling and not self.isStopped:
+      start = self.armOffset(frame_count,time_info)
+      if start >= frame_count:
+        if self.prerollBuffer: self.prerollBuffer.write(data)
+        return (None, pyaudio.paContinue)
+      # an armed recording starts at this frame of the buffer
+      if self.prerollBuffer: self.prerollBuffer.write(data[:start*frameSize])
+      data = data[start*frameSize:]
+      frame_count -= start
+      self.isPrerolling = False
+      self.armStreamTime = None
+    # the first buffer after a preroll is preceded by the prerolled audio
+    if self.prerollBuffer and not self.isStopped:
+      for view in self.prerollBuffer.peek(): self.commit(view)
+      self.prerollBuffer = None
+    # fill a gap with silence so the recording keeps to the clock
+    if missing and not self.isStopped:
+      missing = min(missing,self.framesLeft)
+      self.framesLeft -= missing
+      if not self.isPaused: self.lostFrames += missing
+    if self.lostFrames and not self.isStopped: self.fillLost()
+    # count down the frames, paused or not
+    frames = min(frame_count,self.framesLeft)
+    self.framesLeft -= frames
+    self.timeLeft = float(self.framesLeft)/self.samplingRate
+    self.endTime = self.lastCallbackTime + self.timeLeft
     # normally Continue recording
     returnStatus = pyaudio.paContinue
     # return Abort if stopped
     if self.isStopped:
-      if DEBUG: print "* aborting early"
       returnStatus = pyaudio.paAbort
-    # return Complete when designated time runs out
-    elif self.endStreamTime < time_info['current_time']:
+    # return Complete once the last frame is in
+    elif not self.framesLeft:
       returnStatus = pyaudio.paComplete
-    # return Continue if paused before time runs out
-    elif self.isPaused:
-      returnStatus = pyaudio.paContinue
-    # write the frame data to the wave file if not Paused
-    if not self.isPaused: self.wf.writeframes(in_data)
-    # print where we are in the wave file
-    if DEBUG: print "wave file position %s" % self.wf.tell()
+    # hand the frame data to the writer thread if not Paused
+    if not self.isPaused:
+      if frames < frame_count: data = data[:frames*frameSize]
+      self.commit(data)
     return (None, returnStatus)
+
+  def commit(self,data):
+    """
+    hand data to the writer through the ring buffer, or count its frames
+    as lost if there is no room or there is still silence owed ahead of it
+    """
+    frames = len(data)//(self.inputChannels*self.sampleSize)
+    if self.lostFrames: self.ring.drop(len(data))
+    elif self.ring.write(data):
+      self.framesCommitted += frames
+      return
+    self.lostFrames += frames
+
+  def fillLost(self):
+    """
+    put in as much of the silence for lostFrames as the ring buffer has
+    room for, each stretch listed in gaps at the frame it stands in for
+    """
+    frameSize = self.inputChannels*self.sampleSize
+    n = min(self.lostFrames,(self.ring.size - self.ring.depth())//frameSize)
+    if n and self.ring.writeSilence(n*frameSize):
+      if self.gaps and sum(self.gaps[-1]) == self.framesCommitted:
+        # the rest of the last stretch
+        self.gaps[-1] = (self.gaps[-1][0],self.gaps[-1][1] + n)
+      else: self.gaps.append((self.framesCommitted,n))
+      self.framesCommitted += n
+      self.lostFrames -= n
+
+  def missingFrames(self,frame_count,time_info,status):
+    """
+    the frames lost before this buffer, from the adc time it should have
+    had following the last one, counted with an Input Overflow and
+    otherwise only when a whole buffer or more is missing (the times
+    jitter), 0 when the driver does not give adc times
+    """
+    now = time.time()
+    lastCallbackTime = self.lastCallbackTime
+    self.lastCallbackTime = now
+    adcTime = time_info['input_buffer_adc_time']
+    expected = self.nextAdcTime
+    self.nextAdcTime = adcTime + float(frame_count)/self.samplingRate
+    if self.reconnected:
+      # the reopened stream has a new clock, go by the wall clock
+      self.reconnected = False
+      if lastCallbackTime is None: return 0
+      missing = (int(round((now - lastCallbackTime)*self.samplingRate)) -
+                 frame_count)
+      return max(0,missing)
+    if not adcTime or expected is None: return 0
+    missing = int(round((adcTime - expected)*self.samplingRate))
+    if status & pyaudio.paInputOverflow: least = 1
+    else: least = frame_count
+    if missing < least: return 0
+    return missing
+
+  def armOffset(self,frame_count,time_info):
+    """
+    the frame of this buffer an armed recording starts at,
+    frame_count (not in this buffer) when not armed
+    """
+    if self.armStreamTime is None: return frame_count
+    # some drivers do not give the adc time, then the buffer
+    # is taken to have ended at the current time
+    adcTime = time_info['input_buffer_adc_time']
+    if not adcTime:
+      adcTime = time_info['current_time'] - float(frame_count)/self.samplingRate
+    start = int(round((self.armStreamTime - adcTime)*self.samplingRate))
+    return max(0,min(start,frame_count))
   
   def start(self):
     """
@@ -153,15 +1940,54 @@ class Record:
     a pause is restarted the recording will still stop
     """
     if DEBUG: print("* recording")
-    # only start the stream and set the time if this is not a restart
-    if not self.isPaused:
-      self.endStreamTime = self.stream.get_time() + self.recordSeconds
-      self.stream.start_stream()
+    # only start the stream and set the frames if this is not a restart
+    # or a second start, an armed stream starts itself at the armed time
+    # and from then on framesLeft is only counted down by the callback
+    if not (self.isPaused or self.isStarted or self.isArmed):
+      self.framesLeft = int(self.recordSeconds*self.samplingRate)
+      self.endTime = time.time() + self.recordSeconds
+      if not self.writer.isAlive(): self.writer.start()
+      # a prerolling stream is already running, framesLeft is set
+      # before the callback is let past the preroll
+      if self.isPrerolling: self.isPrerolling = False
+      else: self.stream.start_stream()
     # set tracking flags
     self.isStarted = True
     self.isPaused = False
     self.isStopped = False
     
+  def preroll(self,seconds=PREROLL_SECONDS):
+    """
+    start the stream ahead of start() and keep the last seconds of
+    audio, which then become the beginning of the recording
+    """
+    if self.isStarted: raise RecordingError, 'can not preroll; already started'
+    if seconds >= RING_BUFFER_SECONDS:
+      raise RecordingError, 'preroll must be shorter than the ring buffer'
+    if DEBUG: print("* prerolling %ss" % seconds)
+    frameSize = self.inputChannels*self.sampleSize
+    if seconds:
+      self.prerollBuffer = PrerollBuffer(frameSize*int(self.samplingRate*seconds))
+    self.isPrerolling = True
+    self.stream.start_stream()
+
+  def arm(self,startTime,seconds=PREROLL_SECONDS):
+    """
+    preroll and start recording by itself at startTime (time.time()),
+    on the frame the device sampled at that time, start() can then be
+    called any time before without starting early
+    """
+    if startTime <= time.time(): raise RecordingError, 'can not arm; start time has passed'
+    self.framesLeft = int(self.recordSeconds*self.samplingRate)
+    self.timeLeft = self.recordSeconds
+    self.endTime = startTime + self.recordSeconds
+    self.writer.start()
+    self.isArmed = True
+    self.preroll(seconds)
+    # the stream clock only counts from the PortAudio instance starting
+    self.armStreamTime = startTime - time.time() + self.stream.get_time()
+    if DEBUG: print("* armed for stream time %.3f" % self.armStreamTime)
+
   def pause(self):
     """
     a pause method to allow recording to stop and restart
@@ -183,23 +2009,327 @@ class Record:
     while self.stream.is_active():
       time.sleep(0.1)
     if DEBUG: print("* done recording")
-    self.stream.stop_stream()
-    self.stream.close()
-    self.wf.close()
-    self.endStreamTime = 0
+    # a stream whose device went away can fail to stop
+    try:
+      self.stream.stop_stream()
+      self.stream.close()
+    except IOError:
+      pass
+    # put in the silence still owed, the writer makes room for it
+    while self.lostFrames and self.writer.isAlive():
+      self.fillLost()
+      if self.lostFrames: time.sleep(WRITER_POLL)
+    # flush the ring buffer before closing the wave file and encoder
+    if self.writer.isAlive(): self.writer.stop()
+    for output in self.outputs + self.taps: output.close()
+    if DEBUG: print "ring buffer %s" % self.bufferStats()
+    if self.stats.calls: self.dumpStats()
+    self.framesLeft = 0
+    self.armStreamTime = None
+    self.isArmed = False
     self.timeLeft = 0
     
+  def died(self):
+    """
+    True if the stream stopped by itself while still recording
+    or prerolling, as when its USB device glitches
+    """
+    if self.isStopped or not (self.framesLeft or self.isPrerolling): return False
+    if not (self.isStarted or self.isPrerolling): return False
+    return not self.stream.is_active()
+
+  def reopen(self):
+    """
+    open and start the stream again after it died, the frames lost in
+    between are filled with silence (see missingFrames()), returns False
+    if the device can not be opened yet
+    """
+    try:
+      self.stream.close()
+    except IOError:
+      pass
+    try:
+      if hasattr(self.source,'reset'): self.source.reset()
+      callback = not self.blocking and self.callback or None
+      self.stream = self.source.open(self.inputFormat,self.inputChannels,
+                                     self.samplingRate,self.chunk,callback)
+      self.reconnected = True
+      self.stream.start_stream()
+    except (IOError,ValueError,RecordingError),e:
+      if DEBUG: print "can not reopen %s: %s" % (self.source.name,e)
+      return False
+    self.reconnects += 1
+    if DEBUG: print "* reopened %s" % self.source.name
+    return True
+
+  def giveUp(self):
+    """
+    end a recording whose stream died and could not be reopened in time
+    """
+    if DEBUG: print "* gave up on %s" % self.source.name
+    self.framesLeft = 0
+    self.timeLeft = 0
+    self.isPrerolling = False
+
+  def subscribe(self,fn):
+    """
+    call fn(filename,number,last) each time a segment is closed
+    """
+    if not self.segmented:
+      raise RecordingError, 'can not subscribe; recording is not segmented'
+    self.wf.subscribe(fn)
+
+  def encodedFile(self):
+    """
+    the file compressed while recording, or None if there is not one
+    or the encoder failed
+    """
+    if self.encoder and not self.encoder.failed: return self.encodeFilename
+    return None
+
+  def dspSettings(self):
+    """
+    the DSP stages the frames go through, as in 'gain 6dB'
+    """
+    if self.dsp: return list(self.dsp.settings)
+    return []
+
+  def levels(self):
+    """
+    snapshot of the latest levels (see LevelMeter), empty without NumPy
+    """
+    if self.meter: return self.meter.stats()
+    return {}
+
+  def callbackStats(self):
+    """
+    snapshot of the callback stats (see CallbackStats)
+    """
+    return self.stats.snapshot(self.errorCounter)
+
+  def dumpStats(self):
+    """
+    write the callback and ring buffer stats next to the recording
+    """
+    sidecar = os.path.splitext(self.waveFilename)[0] + STATS_SIDECAR
+    f = open(sidecar,'w')
+    yaml.safe_dump({'callback': self.callbackStats(),
+                    'buffer': self.bufferStats(),
+                    'gaps': self.gapList(),
+                    'reconnects': self.reconnects,
+                    'chunk': self.chunk,
+                    'device': self.source.name},
+                   f,default_flow_style=False)
+    f.close()
+    if DEBUG: print "stats %s" % sidecar
+
+  def gapList(self):
+    """
+    the stretches of silence put in for audio lost to overflows or to a
+    full ring buffer, as [frame,frames] in the recording at the rate it
+    is stored at
+    """
+    scale = float(self.storeRate)/self.samplingRate
+    return [[int(round(frame*scale)),int(round(frames*scale))]
+            for (frame,frames) in self.gaps]
+
+  def bufferStats(self):
+    """
+    ring buffer depth, high water mark and drop counts
+    along with how much the writer thread has written
+    """
+    stats = self.ring.stats()
+    stats['bytesWritten'] = self.writer.bytesWritten
+    stats['batches'] = self.writer.batches
+    return stats
+
   def __del__(self):
     """
     stop recording on way out and terminal pyAudio
     """
     if not self.isStopped: self.stop()  
-    self.p.terminate()
+    if self.ownSource: self.source.terminate()
     if DEBUG:
       for key in self.errorCounter.keys():
         print key,self.errorCounter[key]
 
 
+def expectedSize(seconds,channels=None,storeRate=None):
+  """
+  bytes of a recording of seconds with channels stored at storeRate,
+  Record.inputChannels and STORE_RATE (or the sampling rate) if not given
+  """
+  channels = channels or Record.inputChannels
+  storeRate = storeRate or STORE_RATE or Record.samplingRate
+  sampleSize = pyaudio.get_sample_size(Record.inputFormat)
+  return int(seconds*storeRate)*channels*sampleSize
+
+def expectedSizes(devices,seconds,storeRate=None):
+  """
+  the expectedSize() of the recording of each of devices (as given to
+  Session, an empty list or None for just the default input)
+  """
+  return [expectedSize(seconds,channels,storeRate)
+          for (deviceIndex,channels) in (devices or [(None,None)])]
+
+class Session():
+  """
+  One recording over several input devices, started and stopped together,
+  each device with its own stream, callback and writer (a Record).
+  devices is a list of (deviceIndex,channels), None for either meaning
+  the default input or Record.inputChannels, and the default of None
+  records just the default input.  sources can be given instead of
+  devices (such as those from STELC_Simulator), they are not terminated.
+  expectedBytes is a list of the bytes to preallocate for the recording
+  of each device, as from expectedSizes(), or 0 for none.
+  The first device is the primary recording: it is written to
+  waveFilename with all of the Record options given and it is what gets
+  converted and uploaded.  The others are written next to it with
+  DEVICE_FORMAT inserted in the filename, whole or, with splitChannels,
+  one file per channel (the primary is always written whole as well).
+  Once started a thread watches the streams and reopens any that dies
+  before its recording is done, so a device glitch leaves a gap of
+  silence instead of ending the session.
+  """
+  def __init__(self,devices=None,sources=None,recordSeconds=SECONDS,
+               waveFilename="test_rec.wav",splitChannels=False,
+               expectedBytes=0,**recordArgs):
+    self.ownSources = not sources
+    if self.ownSources:
+      # the first PyAudioSource's PortAudio instance is shared by the others
+      sources = []
+      p = None
+      for (deviceIndex,channels) in (devices or [(None,None)]):
+        sources.append(PyAudioSource(deviceIndex,p))
+        p = sources[0].p
+      sources[0].shared = len(sources) > 1
+    channelList = [channels for (deviceIndex,channels) in
+                   (devices or [(None,None)]*len(sources))]
+    self.sources = sources
+    self.records = []
+    base,ext = os.path.splitext(waveFilename)
+    for (n,source) in enumerate(sources):
+      deviceBytes = expectedBytes and expectedBytes[n] or 0
+      if n == 0:
+        record = Record(recordSeconds=recordSeconds,waveFilename=waveFilename,
+                        source=source,channels=channelList[n],
+                        splitChannels=splitChannels,expectedBytes=deviceBytes,
+                        **recordArgs)
+      else:
+        channels = channelList[n] or Record.inputChannels
+        record = Record(recordSeconds=recordSeconds,
+                        waveFilename=base + DEVICE_FORMAT % (n+1) + ext,
+                        source=source,channels=channels,
+                        splitChannels=splitChannels,
+                        keepWave=not (splitChannels and channels > 1),
+                        expectedBytes=deviceBytes,
+                        storeRate=recordArgs.get('storeRate'),
+                        dsp=recordArgs.get('dsp'),livePort=0)
+      self.records.append(record)
+    self.primary = self.records[0]
+    self.segmented = self.primary.segmented
+    self.wf = self.primary.wf
+    self._stop_ = threading.Event()
+    self.watcher = threading.Thread(target=self.watch)
+    self.watcher.daemon = True
+
+  def watch(self):
+    """
+    reopen the stream of any Record that died, first on the poll after
+    it is seen dead and then every RECONNECT_RETRY_SECONDS until its
+    recording time has run out
+    """
+    retry = {}
+    while not self._stop_.wait(RECONNECT_POLL):
+      now = time.time()
+      for record in self.records:
+        if not record.died():
+          retry.pop(record,None)
+        elif record not in retry:
+          if DEBUG: print "* lost %s" % record.source.name
+          retry[record] = now
+        elif now >= retry[record]:
+          if record.endTime and now > record.endTime: record.giveUp()
+          elif record.reopen(): del retry[record]
+          else: retry[record] = now + RECONNECT_RETRY_SECONDS
+
+  def watching(self):
+    if not self.watcher.isAlive() and not self._stop_.isSet():
+      self.watcher.start()
+
+  def start(self):
+    for record in self.records: record.start()
+    self.watching()
+
+  def pause(self):
+    for record in self.records: record.pause()
+
+  def preroll(self,seconds=PREROLL_SECONDS):
+    for record in self.records: record.preroll(seconds)
+    self.watching()
+
+  def arm(self,startTime,seconds=PREROLL_SECONDS):
+    for record in self.records: record.arm(startTime,seconds)
+    self.watching()
+
+  def stop(self):
+    """
+    stop every Record, then terminate the sources (the one
+    owning the shared PortAudio instance last)
+    """
+    self._stop_.set()
+    if self.watcher.isAlive(): self.watcher.join()
+    for record in self.records: record.stop()
+    if self.ownSources:
+      for source in reversed(self.sources): source.terminate()
+      self.ownSources = False
+
+  def active(self):
+    """
+    the session lasts as long as the primary stream,
+    including while it is being reopened
+    """
+    return self.primary.stream.is_active() or self.primary.died()
+
+  def timeLeft(self):
+    return self.primary.timeLeft
+
+  def subscribe(self,fn):
+    self.primary.subscribe(fn)
+
+  def encodedFile(self):
+    return self.primary.encodedFile()
+
+  def dspSettings(self):
+    return self.primary.dspSettings()
+
+  def levels(self):
+    """
+    the primary's levels with the peak and clip count over all devices
+    """
+    levels = dict(self.primary.levels())
+    for record in self.records[1:]:
+      other = record.levels()
+      if not levels or not other: continue
+      levels['peak'] = max(levels['peak'],other['peak'])
+      levels['clipTotal'] += other['clipTotal']
+    return levels
+
+  def bufferStats(self):
+    """
+    ring buffer stats of each Record by filename
+    """
+    return dict([(record.waveFilename,record.bufferStats())
+                 for record in self.records])
+
+  def callbackStats(self):
+    """
+    callback stats of each Record by filename
+    """
+    return dict([(record.waveFilename,record.callbackStats())
+                 for record in self.records])
+
+
 if __name__ == '__main__':
   DEBUG = 1
   r = Record(recordSeconds=40)
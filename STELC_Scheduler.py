@@ -22,6 +22,7 @@ import sys
 import copy
 
 from apiclient.discovery import build
+from apiclient.errors import HttpError
 from oauth2client.client import SignedJwtAssertionCredentials
 from GoogleCreds import *
 
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+"""
+Simulated inputs for STELC_Recorder.Record so it can be run without an
+ALSA device.  A FileSource replays a wav file and a SyntheticSource
+generates a signal.  Both hand out a SimulatedStream which calls the
+Record's callback the same way a callback mode PyAudio stream does,
+in real time or speed times faster, and flags Input Overflows when the
+callback falls too far behind the simulated device.
+  r = sR.Record(recordSeconds=60,source=SyntheticSource('sine',speed=10))
+"""
+import sys,time,wave,math
+import threading
+import pyaudio
+import STELC_Recorder as sR
+try:
+  import numpy
+except ImportError:
+  # only silence can be synthesized without NumPy
+  numpy = None
+
+DEBUG = 0
+# buffers the simulated device holds before audio is lost
+DEVICE_BUFFERS = 2
+
+class SimulatedStream(threading.Thread):
+  """
+  Stands in for a callback mode pyaudio.Stream, the source's read(frames)
+  supplies each buffer ('' when it runs out) and skip(frames) throws
+  away audio lost to an overflow.
+  speed is how many times faster than real time to run, 0 for as fast
+  as the callback allows (which never overflows).
+  The start time and duration of every callback are kept for benchmarks.
+  """
+  def __init__(self,source,frameSize,rate,framesPerBuffer,callback,speed):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.source = source
+    self.frameSize = frameSize
+    self.rate = rate
+    self.framesPerBuffer = framesPerBuffer
+    self.callback = callback
+    self.speed = speed
+    # stream position in frames, including any lost to overflows
+    self.frames = 0
+    self.active = False
+    self.startTime = None
+    self.overflows = 0
+    self.callTimes = []
+    self.callDurations = []
+
+  def start_stream(self):
+    self.active = True
+    self.startTime = time.time()
+    self.start()
+
+  def stop_stream(self):
+    self.active = False
+
+  def close(self):
+    self.active = False
+    if self.isAlive() and threading.currentThread() is not self: self.join()
+
+  def is_active(self):
+    return self.active
+
+  def get_time(self):
+    if self.speed and self.startTime:
+      return (time.time() - self.startTime)*self.speed
+    return float(self.frames)/self.rate
+
+  def run(self):
+    period = float(self.framesPerBuffer)/self.rate
+    status = 0
+    while self.active:
+      if self.speed:
+        # wait for the device to fill the next buffer
+        due = (self.startTime +
+               float(self.frames + self.framesPerBuffer)/self.rate/self.speed)
+        wait = due - time.time()
+        if wait > 0: time.sleep(wait)
+        elif -wait > DEVICE_BUFFERS*period/self.speed:
+          # the device overran while the callback was busy
+          missed = int(-wait/(period/self.speed))*self.framesPerBuffer
+          self.source.skip(missed)
+          self.frames += missed
+          self.overflows += 1
+          status |= pyaudio.paInputOverflow
+          if DEBUG: print "simulated overflow, %d frames lost" % missed
+      data = self.source.read(self.framesPerBuffer)
+      if not data: break
+      frameCount = len(data)//self.frameSize
+      timeInfo = {'input_buffer_adc_time': float(self.frames)/self.rate,
+                  'current_time': self.get_time(),
+                  'output_buffer_dac_time': 0.}
+      self.frames += frameCount
+      callTime = time.time()
+      self.callTimes.append(callTime)
+      (outData,flag) = self.callback(data,frameCount,timeInfo,status)
+      self.callDurations.append(time.time() - callTime)
+      status = 0
+      if flag != pyaudio.paContinue: break
+    self.active = False
+
+class FileSource():
+  """
+  A Record source which replays a wav file, which has to have the
+  same channels, sample size and rate as the Record.
+  loop starts the file over instead of ending the stream.
+  """
+  def __init__(self,filename,speed=1.0,loop=False):
+    self.filename = filename
+    self.speed = speed
+    self.loop = loop
+    self.deviceIndex = None
+    self.name = 'file:%s' % filename
+    self.wf = None
+
+  def open(self,inputFormat,channels,rate,framesPerBuffer,callback):
+    self.wf = wave.open(self.filename,'rb')
+    if (self.wf.getnchannels() != channels or
+        self.wf.getframerate() != rate or
+        self.wf.getsampwidth() != pyaudio.get_sample_size(inputFormat)):
+      raise sR.RecordingError, '%s does not match the recording format' % self.filename
+    self.frameSize = channels*self.wf.getsampwidth()
+    return SimulatedStream(self,self.frameSize,rate,framesPerBuffer,
+                           callback,self.speed)
+
+  def read(self,frames):
+    data = self.wf.readframes(frames)
+    if len(data) < frames*self.frameSize and self.loop:
+      self.wf.rewind()
+      data += self.wf.readframes(frames - len(data)//self.frameSize)
+    return data
+
+  def skip(self,frames):
+    self.read(frames)
+
+  def terminate(self):
+    if self.wf: self.wf.close()
+
+class SyntheticSource():
+  """
+  A Record source which generates kind 'sine' (of frequency Hz),
+  'noise' or 'silence' at level dBFS, the same on every channel.
+  seconds ends the stream after that much audio, None runs until stopped.
+  """
+  def __init__(self,kind='sine',frequency=440.,level=-20.,speed=1.0,seconds=None):
+    if kind not in ('sine','noise','silence'):
+      raise sR.RecordingError, 'unknown synthetic signal %s' % kind
+    if not numpy and kind != 'silence':
+      raise sR.RecordingError, 'NumPy is needed to synthesize %s' % kind
+    self.kind = kind
+    self.frequency = frequency
+    self.level = level
+    self.speed = speed
+    self.seconds = seconds
+    self.deviceIndex = None
+    self.name = 'synthetic:%s' % kind
+    self.position = 0
+
+  def open(self,inputFormat,channels,rate,framesPerBuffer,callback):
+    self.sampleSize = pyaudio.get_sample_size(inputFormat)
+    if self.sampleSize not in (2,4):
+      raise sR.RecordingError, 'can not synthesize %d byte samples' % self.sampleSize
+    self.channels = channels
+    self.rate = rate
+    self.amplitude = 2**(8*self.sampleSize-1)*10**(self.level/20.)
+    return SimulatedStream(self,channels*self.sampleSize,rate,framesPerBuffer,
+                           callback,self.speed)
+
+  def read(self,frames):
+    if self.seconds is not None:
+      frames = min(frames,int(self.seconds*self.rate) - self.position)
+      if frames <= 0: return ''
+    if self.kind == 'silence':
+      data = '\0'*(frames*self.channels*self.sampleSize)
+    else:
+      if self.kind == 'sine':
+        t = (self.position + numpy.arange(frames))/float(self.rate)
+        signal = self.amplitude*numpy.sin(2*math.pi*self.frequency*t)
+      else:
+        signal = numpy.random.normal(0.,self.amplitude,frames)
+      fullScale = 2**(8*self.sampleSize-1)
+      signal = numpy.clip(signal,-fullScale,fullScale-1)
+      data = numpy.repeat(signal.astype('<i%d' % self.sampleSize),
+                          self.channels).tostring()
+    self.position += frames
+    return data
+
+  def skip(self,frames):
+    self.position += frames
+
+  def terminate(self):
+    pass
+
+
+if __name__ == '__main__':
+  # record ten seconds of a sine wave ten times faster than real time
+  # or replay the wav file given
+  sR.DEBUG = 1
+  if len(sys.argv) > 1: source = FileSource(sys.argv[-1],speed=10.)
+  else: source = SyntheticSource('sine',speed=10.)
+  r = sR.Record(recordSeconds=10,waveFilename='test_sim.wav',source=source)
+  r.start()
+  while r.stream.is_active():
+    time.sleep(0.1)
+  r.stop()
+  print r.levels()
+  del r
+  source.terminate()
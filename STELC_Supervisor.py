@@ -0,0 +1,265 @@
+#!/usr/bin/python
+"""
+used by the Copier, the Dropbox uploader and the Converter to run a
+command without blocking on it.  Its stdout and stderr are read as they
+come with select.poll, written to the logs and split into lines at \n or
+\r (rsync and curl redraw their progress with \r), each line is handed
+to the parser which can return a new progress.
+A command that runs longer than timeout, or shows no sign of life (no
+output read or input written) for idleTimeout, is ended, as is one that
+is cancelled from another thread.  Ending sends SIGTERM to the command's
+process group and SIGKILL KILL_SECONDS later.
+Progress is published as events to the subscribers, see subscribe().
+  s = Supervisor(['rsync','-P','a','b'],parser=parseRsync,idleTimeout=60)
+  s.subscribe(show)
+  s.run()
+"""
+import os,sys,time,re
+import errno,fcntl,select,signal
+import subprocess
+
+DEBUG = 1
+# seconds between polls, the longest a cancel or timeout waits
+POLL_SECONDS = 0.2
+# seconds a command is given to end after SIGTERM before SIGKILL
+KILL_SECONDS = 5.0
+# bytes read from a pipe at a time
+READ_BYTES = 64*1024
+
+class SupervisorError(Exception):
+  pass
+
+class Supervisor():
+  """
+  Runs command (a list, or a string with shell) and watches it.
+  parser(stream,line) is called with 'stdout' or 'stderr' and each line,
+  returning a progress string or None to leave it as it is.
+  stdoutLog and stderrLog are open files for the raw output (the same
+  file for both is fine), with input the command's stdin is a pipe
+  fed with write() and closed with closeInput().
+  state is 'new', 'running', then 'done', 'failed', 'cancelled' or
+  'timeout' once the command has ended.
+  """
+  def __init__(self,command,parser=None,stdoutLog=None,stderrLog=None,
+               timeout=None,idleTimeout=None,input=False,nice=0,shell=False):
+    self.command = command
+    self.parser = parser
+    self.logs = {'stdout': stdoutLog,'stderr': stderrLog}
+    self.timeout = timeout
+    self.idleTimeout = idleTimeout
+    self.input = input
+    self.nice = nice
+    self.shell = shell
+    self.process = None
+    self.state = 'new'
+    self.progress = None
+    self.returncode = None
+    self.cancelled = False
+    self.timedOut = False
+    self.started = None
+    self.lastActive = None
+    self.killTime = None
+    self.subscribers = []
+    self.streams = {}
+    self.partial = {}
+    self.poller = None
+
+  def subscribe(self,callback):
+    """
+    callback(event) is called from the thread running the command when
+    it starts, when the progress changes and when it ends, event is a
+    dictionary of 'state', 'progress', 'line', 'returncode' and 'elapsed'
+    """
+    self.subscribers.append(callback)
+
+  def publish(self,line=None):
+    event = {'state': self.state,
+             'progress': self.progress,
+             'line': line,
+             'returncode': self.returncode,
+             'elapsed': self.started and time.time() - self.started or 0.}
+    for callback in self.subscribers:
+      callback(event)
+
+  def preexec(self):
+    """
+    run in the child before the command, its own process group lets
+    a shell be ended along with what it started
+    """
+    os.setsid()
+    if self.nice: os.nice(self.nice)
+
+  def start(self):
+    if DEBUG: print "supervise: %s" % self.command
+    self.process = subprocess.Popen(self.command,
+                                    shell=self.shell,
+                                    stdin=self.input and subprocess.PIPE or None,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    close_fds=True,
+                                    preexec_fn=self.preexec)
+    self.started = self.lastActive = time.time()
+    self.poller = select.poll()
+    for (name,pipe) in (('stdout',self.process.stdout),
+                        ('stderr',self.process.stderr)):
+      self.streams[pipe.fileno()] = name
+      self.partial[name] = ''
+      self.poller.register(pipe.fileno(),select.POLLIN | select.POLLPRI)
+    if self.input:
+      fd = self.process.stdin.fileno()
+      fcntl.fcntl(fd,fcntl.F_SETFL,fcntl.fcntl(fd,fcntl.F_GETFL) | os.O_NONBLOCK)
+    self.state = 'running'
+    self.publish()
+
+  def cancel(self):
+    """
+    end the command, safe to call from another thread
+    """
+    self.cancelled = True
+    if self.process and self.process.returncode is None: self.terminate()
+
+  def terminate(self):
+    """
+    SIGTERM the command's process group, pump() follows up with SIGKILL
+    """
+    if self.killTime is None: self.killTime = time.time() + KILL_SECONDS
+    self.signal(signal.SIGTERM)
+
+  def signal(self,sig):
+    try:
+      os.killpg(self.process.pid,sig)
+    except OSError:
+      # already gone
+      pass
+
+  def checkTimeouts(self):
+    now = time.time()
+    if ((self.timeout and now - self.started > self.timeout) or
+        (self.idleTimeout and now - self.lastActive > self.idleTimeout)):
+      if not self.timedOut and DEBUG: print "timed out: %s" % self.command
+      self.timedOut = True
+    if (self.cancelled or self.timedOut) and self.process.returncode is None:
+      if self.killTime is None: self.terminate()
+      elif now > self.killTime: self.signal(signal.SIGKILL)
+
+  def pump(self,wait=0.):
+    """
+    read what output there is, waiting up to wait seconds for some,
+    and return True while the command is still going
+    """
+    if self.streams:
+      try:
+        events = self.poller.poll(int(1000*wait))
+      except select.error,e:
+        if e[0] != errno.EINTR: raise
+        events = []
+      for (fd,event) in events:
+        self.read(fd)
+    elif wait:
+      time.sleep(wait)
+    self.checkTimeouts()
+    if not self.streams and self.process.poll() is not None:
+      self.end()
+      return False
+    return True
+
+  def read(self,fd):
+    name = self.streams[fd]
+    data = os.read(fd,READ_BYTES)
+    if not data:
+      # end of file, flush any last line without an end
+      self.poller.unregister(fd)
+      del self.streams[fd]
+      if self.partial[name]: self.parse(name,self.partial[name])
+      self.partial[name] = ''
+      return
+    self.lastActive = time.time()
+    if self.logs[name]:
+      self.logs[name].write(data)
+      self.logs[name].flush()
+    lines = re.split('[\r\n]',self.partial[name] + data)
+    self.partial[name] = lines.pop()
+    for line in lines:
+      if line: self.parse(name,line)
+
+  def parse(self,name,line):
+    if not self.parser: return
+    progress = self.parser(name,line)
+    if progress is not None and progress != self.progress:
+      self.progress = progress
+      self.publish(line)
+
+  def write(self,data):
+    """
+    feed data to the command's stdin, keeping its output read, raises
+    SupervisorError if the command ends or is ended first
+    """
+    fd = self.process.stdin.fileno()
+    writePoll = select.poll()
+    writePoll.register(fd,select.POLLOUT)
+    view = buffer(data)
+    while len(view):
+      self.checkTimeouts()
+      if self.cancelled or self.timedOut:
+        raise SupervisorError, 'input to %s stopped' % self.command
+      try:
+        written = os.write(fd,view)
+      except OSError,e:
+        if e.errno == errno.EPIPE:
+          raise SupervisorError, '%s stopped reading its input' % self.command
+        if e.errno != errno.EAGAIN: raise
+        written = 0
+      if written:
+        view = buffer(view,written)
+        self.lastActive = time.time()
+      else:
+        # wait for room in the pipe while draining the output
+        self.pump()
+        writePoll.poll(int(1000*POLL_SECONDS))
+
+  def closeInput(self):
+    if self.input and not self.process.stdin.closed:
+      try:
+        self.process.stdin.close()
+      except IOError:
+        pass
+
+  def wait(self):
+    """
+    wait for the command to end and return its state
+    """
+    self.closeInput()
+    while self.pump(POLL_SECONDS): pass
+    return self.state
+
+  def run(self):
+    """
+    start the command, wait for it to end and return its state
+    """
+    self.start()
+    return self.wait()
+
+  def end(self):
+    self.closeInput()
+    self.process.stdout.close()
+    self.process.stderr.close()
+    self.returncode = self.process.returncode
+    if self.cancelled: self.state = 'cancelled'
+    elif self.timedOut: self.state = 'timeout'
+    elif self.returncode == 0: self.state = 'done'
+    else: self.state = 'failed'
+    if DEBUG: print "%s %s %s" % (self.state,self.returncode,self.command)
+    self.publish()
+
+
+if __name__ == '__main__':
+  # run the command given, showing its lines and any percentage in them
+  def parsePercent(stream,line):
+    print "%s: %s" % (stream,line)
+    match = re.search('([0-9.]+%)',line)
+    return match and match.group(1)
+  def show(event):
+    print event
+  s = Supervisor(sys.argv[1:],parser=parsePercent)
+  s.subscribe(show)
+  print s.run()
@@ -10,9 +10,12 @@ This will require a Dropbox account and some interaction with
 Dropbox to get it set up.
 """
 import subprocess,os.path,sys,re
+import STELC_Supervisor as sP
 
 UPLOADER = '/home/pi/Dropbox-Uploader/dropbox_uploader.sh'
 DEBUG = 1
+# an upload that shows no progress for this many seconds is ended
+UPLOAD_IDLE_TIMEOUT = 300
 
 class Upload():
   """
@@ -22,6 +25,16 @@ class Upload():
     self.progress = '.'
     self.localFile = ''
     self.remoteFile = ''
+    self.supervisor = None
+    self.cancelled = False
+
+  def cancel(self):
+    """
+    stop an upload running in another thread
+    """
+    self.cancelled = True
+    supervisor = self.supervisor
+    if supervisor: supervisor.cancel()
 
   def upload(self,uploadFile):
     """
@@ -40,28 +53,29 @@ class Upload():
     # TODO for big files the -p optin does not seem to report the % uploaded
     # However the stdout sill has the ..... perhaps I should just count the 
     # dots for a progress meter.
-    uploadPipe = subprocess.Popen(
+    self.supervisor = sP.Supervisor(
       [UPLOADER,'-p','upload',self.localFile,self.remoteFile],
-      bufsize=-1,
-      stdout=subprocess.PIPE,
-      stderr=subprocess.PIPE,
-      universal_newlines=True,
-      close_fds=True)
-    while uploadPipe.poll() == None:
-      line = uploadPipe.stderr.readline()
-      while line:
-        pipeErr.write(line)
-        pipeErr.flush()
-        myMatch = re.search(' ([0-9\.]+%)$',line)
-        if myMatch:
-          self.progress = myMatch.group(1)
-        if DEBUG: print "upload progress %s" % self.progress
-        line = uploadPipe.stderr.readline()
-
-    pipeOut.writelines(uploadPipe.stdout.readlines())
-    if DEBUG: print "DONE %s" % uploadPipe.poll()
+      parser=self.parseUpload,
+      stdoutLog=pipeOut,stderrLog=pipeErr,
+      idleTimeout=UPLOAD_IDLE_TIMEOUT)
+    if self.cancelled: self.supervisor.cancel()
+    state = self.supervisor.run()
+    if DEBUG: print "DONE %s %s" % (state,self.supervisor.returncode)
+    self.supervisor = None
     pipeOut.close()
     pipeErr.close()
+    return state == 'done'
+
+  def parseUpload(self,stream,line):
+    """
+    the percent uploaded from a line of the uploader's stderr
+    """
+    if stream != 'stderr': return None
+    myMatch = re.search(' ([0-9\.]+%)$',line)
+    if myMatch:
+      self.progress = myMatch.group(1)
+    if DEBUG: print "upload progress %s" % self.progress
+    return self.progress
 
 if __name__ == '__main__':
   u = Upload()
@@ -27,6 +27,8 @@ from apiclient.http import MediaFileUpload
 from GoogleCreds import *
 
 DEBUG = 2
+# bytes sent at a time, the upload can be cancelled between them
+UPLOAD_CHUNK_BYTES = 1024*1024
 
 class Upload():
   """
@@ -39,6 +41,13 @@ class Upload():
     self.remoteFile = ''
     self.http = None
     self.service = None
+    self.cancelled = False
+
+  def cancel(self):
+    """
+    stop an upload running in another thread after the chunk being sent
+    """
+    self.cancelled = True
 
   def connect(self):
     """
@@ -104,7 +113,8 @@ class Upload():
     if ext == '.mp3' or ext == '.MP3': mime_type='audio/mpeg'
     if ext == '.wav' or ext == '.WAV': mime_type='audio/x-wav'
     if ext == '.log' or ext == '.log': mime_type='text/plain'
-    media_body = MediaFileUpload(self.localFile,mimetype=mime_type,resumable=True)
+    media_body = MediaFileUpload(self.localFile,mimetype=mime_type,
+                                 chunksize=UPLOAD_CHUNK_BYTES,resumable=True)
     body = {
       'title': uploadFile,
       'descrption': 'recorded service',
@@ -112,9 +122,14 @@ class Upload():
       'parents': [{'id': folderId}]
     }
     try:
-      thisFile = self.service.files().insert(
-        body=body,
-        media_body=media_body).execute(http=self.http)
+      request = self.service.files().insert(body=body,media_body=media_body)
+      thisFile = None
+      while thisFile is None:
+        if self.cancelled:
+          if DEBUG: print 'upload of %s cancelled' % uploadFile
+          return None
+        (status,thisFile) = request.next_chunk(http=self.http)
+        if status: self.progress = '%d%%' % int(100*status.progress())
       if DEBUG: print 'File ID: %s' % thisFile['id']
       if DEBUG > 1: pprint.pprint(thisFile)
       return thisFile
@@ -8,8 +8,11 @@ import STELC_UploaderDropbox as sUD
 import STELC_UploaderGoogleDrive as sU
 import STELC_Converter as sV
 import STELC_Copier as sC
+import STELC_Supervisor as sP
+import STELC_Cache as sH
 import threading
 import time,os,re,glob,sys
+import yaml
 
 # LOOP_DELAY from STELC_DISPLAY is the delay between display update loops
 # LOOP_DELAY = 0.2
@@ -23,12 +26,57 @@ import time,os,re,glob,sys
 # default record time if none given
 RECORD_SECONDS_DEFAULT = 60*90
 #RECORD_SECONDS_DEFAULT = 40
+# split recordings into numbered files every SEGMENT_SECONDS seconds or
+# SEGMENT_BYTES bytes so convert and upload can start before the end
+# of the event, 0 for both records a single file
+SEGMENT_SECONDS = 0
+SEGMENT_BYTES = 0
+# compress to this format while recording so the convert step is skipped
+# ('' to convert after recording), STREAM_ENCODE_KEEP_WAVE also writes the wav
+STREAM_ENCODE_FORMAT = ''
+STREAM_ENCODE_KEEP_WAVE = True
+# convert only from the first to the last sound found while recording
+# and, with SKIP_SILENCE, leave out long silent stretches in between
+# (see the .silence.yaml sidecar written next to each recording)
+TRIM_SILENCE = True
+SKIP_SILENCE = False
+# formats each recording is converted to from one read of the wav file,
+# the first is the one uploaded, such as ['mp3','flac'] to keep a FLAC
+# archive as well (see STELC_Converter)
+CONVERT_FORMATS = ['mp3']
+# input devices to record from together as (device index, channels),
+# an empty list records just the default input.  The first device is
+# the one converted and uploaded, SPLIT_CHANNELS also writes a wav file
+# per channel of each device
+INPUT_DEVICES = []
+SPLIT_CHANNELS = False
+# open the input PREROLL_ARM_SECONDS before a scheduled event so the
+# recording starts on the frame sampled at the start of the event, and
+# keep PREROLL_SECONDS ahead of it as well (0 to keep none)
+# (PREROLL_ARM_SECONDS 0 to open the input when the recording starts)
+PREROLL_SECONDS = 10
+PREROLL_ARM_SECONDS = 60
 
 # string first argument for time.strftime()
 WAVE_FILENAME_FORMAT = 'STELC_%Y%m%d-%H%M.wav' # string first argument for time.strftime()
 PURGE_RE = 'STELC_[0-9]{8}-[0-9]{4}\.' # regular expression for finding files 
                                        # to purge this needs to match the 
                                        # WAVE_FILENAME_FORMAT
+# recordings cut short by a crash are repaired on startup and converted
+# and uploaded, but like after a clean stop the extra channel and device
+# files matching this are only kept
+RECOVER_SKIP_RE = '\.(ch|dev)[0-9]+\.'
+# recordings left as wav files (by a crash, a cancel or a manual record)
+# are converted in the background, oldest first, at BACKLOG_NICE.
+# The queue is kept in BACKLOG_FILENAME along with the files that failed
+# to convert, which are not tried again until taken off that list.
+# The backlog waits while recording or BACKLOG_HOLD_SECONDS before an
+# event, cancelling a convert in progress, and is rescanned every
+# BACKLOG_SCAN_SECONDS
+BACKLOG_FILENAME = 'STELC_backlog.yaml'
+BACKLOG_NICE = 19
+BACKLOG_HOLD_SECONDS = 15*60
+BACKLOG_SCAN_SECONDS = 10*60
 
 # time HH:MM to daily update the schedule based on the calendar
 # (updates also happen after events)
@@ -39,15 +87,28 @@ SPACE_ALLOWANCE_FACTOR = 2.5
 # used for indicating progress if needed
 PROGRESS_CHARS = ['.','^','>','v','<']
 
-DEBUG = 1
+# debug level, 0 turns the debug output off
+DEBUG = int(os.environ.get('STELC_DEBUG',1))
 sR.DEBUG = DEBUG
 sR.INPUT_FORMAT = sR.pyaudio.paInt16
 sR.SAMPLE_SIZE = sR.pyaudio.get_sample_size(sR.INPUT_FORMAT)
 sR.INPUT_CHANNELS = 1
 sR.SAMPLING_RATE = 48000
+# rate to store recordings at, 16000 or 22050 is plenty for speech
+# and saves on storage and encoding, 0 stores at SAMPLING_RATE
+sR.STORE_RATE = 0
+# processing applied while recording, see STELC_Recorder.DSP_CHAIN
+# such as [('highpass',80.),('gain',6.),('limit',-3.)]
+sR.DSP_CHAIN = []
+# port to listen to the recording live on over the local network,
+# as http://<pi>:<port>/live.wav, 0 for none
+sR.LIVE_PORT = 0
 
 sV.DEBUG = DEBUG
-sV.CONVERTER = '/usr/bin/sox -S %s %s' 
+# recordings longer than this are encoded to MP3 in pieces on all the
+# cores at once, only if lame is installed (see STELC_Converter.CHUNK_ENCODER)
+if os.access(sV.CHUNK_ENCODER.split()[0],os.X_OK): sV.CHUNK_MIN_SECONDS = 5*60
+else: sV.CHUNK_MIN_SECONDS = 0
 
 sU.DEBUG = DEBUG
 sUD.DEBUG = DEBUG
@@ -55,6 +116,8 @@ sUD.DEBUG = DEBUG
 sS.DEBUG = DEBUG
 
 sC.DEBUG = DEBUG
+sP.DEBUG = DEBUG
+sH.DEBUG = DEBUG
 sC.PROGRESS_CHARS = PROGRESS_CHARS
 sC.COPYCMD = "rsync -Pt --modify-window=2 --include='*.mp3' --include='*.wav' --include='*.log' --exclude='*' ./* %s/STELC_pi/"
   
@@ -71,6 +134,15 @@ class Controller(threading.Thread):
     self.converter = converter
     self.uploader = uploader
     self.copier = copier
+    # closed recording segments are converted and uploaded in the
+    # background while the rest of the event is still recording
+    self.recorder.subscribeSegments(self.segmentClosed)
+    self.converter.uploadQueue = self.uploader.queue
+    # recordings left unfinished by a crash, fixed up before anything
+    # records, looked up on the calendar by the Scheduler thread and
+    # handed on in checkSchedule() when nothing is near
+    self.scheduler.lookups.extend([fn for fn in sR.recoverWaves()
+                                   if not re.search(RECOVER_SKIP_RE,fn)])
     self.display = Display()
     self.display.status.message = DEFAULT_STATUS
     # create a namespace dictionary for the action methods
@@ -197,6 +269,8 @@ class Controller(threading.Thread):
       elif self.uploader._stop_.isSet(): self.stop()
       elif self.copier._stop_.isSet(): self.stop()
       else: self.checkSchedule()
+      # keep the backlog out of the way of recording and converting
+      if self.backlogHeld(): self.converter.holdBacklog()
         
       self.display.update()
       time.sleep(LOOP_DELAY)
@@ -215,13 +289,43 @@ class Controller(threading.Thread):
       # if the controller thinks we are recording, clear the event and stop
       self._recording_.clear()
       recordedFile = self.recorder.stopRecording()
+      if self.scheduler._event_.isSet() and self.recorder.clip is not None:
+        self.scheduler.updateItems(recordClip=self.recorder.clip)
+      # the event's filename is never written when it is segmented,
+      # its segments are converted and uploaded one by one instead
+      segmented = bool(self.recorder.segments)
+      if segmented and self.scheduler._event_.isSet():
+        self.scheduler.updateItems(segments=self.recorder.segments)
       # now pass off to the next step
-      self.convert(recordedFile)
+      # the stream encode is not trimmed, so if there is
+      # silence to trim convert the wav after all
+      if (self.recorder.encodedFile and
+          not (self.recorder.keepWave and not segmented and
+               self.converter.keepRegions(recordedFile))):
+        # already compressed while recording so go straight to upload
+        if self.scheduler._event_.isSet():
+          self.scheduler.updateItems(converted=True,
+                                     convertFmt=self.recorder.encodeFormat)
+        self.upload(self.recorder.encodedFile)
+      elif not os.path.exists(recordedFile):
+        # the encoder failed and there is no wav to convert instead
+        if DEBUG: print "stream encode failed, no %s to convert" % recordedFile
+        self.failed('stream encode')
+      else:
+        self.convert(recordedFile,trim=not segmented)
       #self.upload(recordedFile)
     elif self._converting_.isSet():
       self._converting_.clear()
+      if self.converter._converting_.isSet():
+        # cancelled from the display, the wav is left for the backlog
+        self.converter.cancelConvert()
+        self.cancelled()
+        return
       convertedFile = self.converter.convertedFile
-      # TODO find way to terminate convert
+      if not convertedFile:
+        # nothing to upload, not even the wav
+        self.failed('convert')
+        return
       if DEBUG: print "convert %s complete" % self.converter.progress
       # if this is a scheduled event update the events convert status
       if self.scheduler._event_.isSet():
@@ -231,12 +335,17 @@ class Controller(threading.Thread):
       self.upload(convertedFile)
     elif self._uploading_.isSet():
       self._uploading_.clear()
+      if self.uploader._uploading_.isSet():
+        # cancelled from the display
+        self.uploader.cancelUpload()
+        self.cancelled()
+        return
       uploadedFile = self.uploader.uploadFile
-      # TODO find way to terminate upload
       if DEBUG: print "upload %s complete" % self.uploader.progress
       # if this is a scheduled event update the events upload status
       if self.scheduler._event_.isSet():
-        self.scheduler.updateItems(uploaded=True)
+        self.scheduler.updateItems(uploaded=True,
+                                   remoteId=self.uploader.remoteId)
         # this marks the end of a scheduled event
         self.scheduler._event_.clear()
         # so we should update the schedule
@@ -244,7 +353,12 @@ class Controller(threading.Thread):
       self.idle()
     elif self._copying_.isSet():
       self._copying_.clear()
-      # TODO find way to terminate copy
+      if self.copier._copying_.isSet():
+        # cancelled from the display, the sticks are still unmounted
+        self.copier.cancelCopy()
+        self.display.status.message = "cancel copy"
+        self.display.update()
+        while self.copier._copying_.isSet(): time.sleep(LOOP_DELAY)
       if DEBUG: print "copy progress: %s" % self.copier.progress
       self.idle()
     else:
@@ -255,6 +369,28 @@ class Controller(threading.Thread):
       # TODO this is risky because it does not give a status
       self.scheduler.uploadLogs()
 
+  def cancelled(self):
+    """
+    Called after a convert or upload is cancelled from the display,
+    the event is over as far as the schedule goes
+    """
+    if self.scheduler._event_.isSet():
+      self.scheduler.updateItems(cancelled=True)
+      self.scheduler._event_.clear()
+      self.updateSchedule()
+    self.idle()
+
+  def failed(self,step):
+    """
+    Called when step leaves nothing to pass on to the next one,
+    the event is over as far as the schedule goes
+    """
+    if self.scheduler._event_.isSet():
+      self.scheduler.updateItems(failed=step)
+      self.scheduler._event_.clear()
+      self.updateSchedule()
+    self.idle()
+
   def record(self, recordSeconds = RECORD_SECONDS_DEFAULT):
     """
     Called when requested to record
@@ -264,6 +400,9 @@ class Controller(threading.Thread):
     self._recording_.set()
     # set up and start the recoring in the recorder thread
     self.recorder.setRecordSeconds(recordSeconds)
+    # so the wave files can be preallocated
+    self.recorder.expectedBytes = self.scheduler.getExpectedSizes(recordSeconds)
+    # a prerolling recorder keeps the filename it was given
     fn = self.recorder.setFilename()
     self.recorder.startRecording()
     # wait untill the recording actually starts
@@ -277,13 +416,19 @@ class Controller(threading.Thread):
     print 'record method'
     # if this is a scheduled event update the events filename
     if self.scheduler._event_.isSet():
-      self.scheduler.updateItems(filename=fn)
+      self.scheduler.updateItems(filename=fn,dsp=self.recorder.dspSettings())
 
   def recording(self):
     """
     Called while recording is running (called from conrtroller run() loop)
     """
-    self.display.status.message = "recording..."
+    levels = self.recorder.levels()
+    if levels:
+      # peak level and clip count instead of just recording...
+      self.display.status.message = "rec %ddB c%d" % (levels['peak'],
+                                                     levels['clipTotal'])
+    else:
+      self.display.status.message = "recording..."
     # not implimenting this since timLeft() is jumpy based on chunk size
     #if self.recorder.timeLeft() < RECORD_END_WARNING:
     #  self.display.time.deltaStart = time.time() + self.recorder.timeLeft()
@@ -291,17 +436,30 @@ class Controller(threading.Thread):
     if not self.recorder.recordStreamActive():
       self.cancel()
 
-  def convert(self,filename):
+  def segmentClosed(self,filename,number,last):
+    """
+    Called from the recorder's writer thread when a segment is closed
+    the last segment goes through the normal convert and upload steps
     """
-    Called when requested to convert
+    if not last: self.converter.queue.append(filename)
+
+  def convert(self,filename,trim=True):
+    """
+    Called when requested to convert, trim=False converts the whole
+    file whatever silence was found
     """
     self.clearAll()
     self._converting_.set()
     # do convertion here
     self.converter.convertFile = filename
+    self.converter.convertTrim = trim
     self.converter._startConvert_.set()
-    while not self.converter._converting_.isSet():
-      if DEBUG: "wait for convert to start"
+    # a queued or backlog convert gives way so this one starts right away
+    self.converter.preempt()
+    # the converter clears this once it has the file, which may already
+    # be converted
+    while self.converter._startConvert_.isSet():
+      time.sleep(LOOP_DELAY)
     self.display.time.deltaStart = time.time()
     self.display.update(PROCESS)
     self.display.query.setDefaultQuery(self.waitQueryNum)
@@ -327,8 +485,10 @@ class Controller(threading.Thread):
     # do the upload here
     self.uploader.uploadFile = uploadFile
     self.uploader._startUpload_.set()
-    while not self.uploader._uploading_.isSet():
-      if DEBUG: "wait for upload to start"
+    # a queued upload gives way so this one starts right away
+    self.uploader.preempt()
+    while self.uploader._startUpload_.isSet():
+      time.sleep(LOOP_DELAY)
     #
     self.display.time.deltaStart = time.time()
     self.display.update(PROCESS)
@@ -365,7 +525,7 @@ class Controller(threading.Thread):
     # do the copy here
     self.copier._startCopy_.set()
     while not self.copier._copying_.isSet():
-      if DEBUG: "wait for copy to start"
+      time.sleep(LOOP_DELAY)
     #
     self.display.time.deltaStart = time.time()
     self.display.update(PROCESS)
@@ -394,11 +554,62 @@ class Controller(threading.Thread):
       self.display.time.deltaStart = self.scheduler.getStart()
       self.display.status.message = "record in"
       self.display.update(PROCESS)
-    # as soon as it is close to the time start recording
-    if self.scheduler.isNear():
+    # shortly before, arm the input for the start of the event
+    if PREROLL_ARM_SECONDS and self.scheduler.isNear(PREROLL_ARM_SECONDS):
+      if not self.recorder.prerolling(): self.preroll()
+    elif self.recorder.prerolling() and not self.scheduler.isUnderway():
+      # the event has gone away from the schedule
+      self.recorder.cancelPreroll()
+    # as soon as it is close to the time start recording, or if the
+    # start went by while armed (it still starts on the armed frame)
+    if (self.scheduler.isNear() or
+        (self.recorder.prerolling() and self.scheduler.isUnderway())):
       self.scheduler._event_.set()
       # provide the duration when starting record()
       self.record(recordSeconds = self.scheduler.getDuration())
+    elif self.scheduler.found and not self.scheduler.isNear(15*60):
+      self.recover()
+
+  def recover(self):
+    """
+    Called when idle to pass on a recording recovered after a crash once
+    the Scheduler has looked it up, the one of a calendar event goes
+    through the convert and upload steps for that event, others (such as
+    segments) are queued in the background
+    """
+    (filename,event) = self.scheduler.found.pop(0)
+    if event:
+      self.scheduler.schedule.event = event
+      self.scheduler._event_.set()
+      self.scheduler.updateItems(recovered=True)
+      self.convert(filename)
+    else: self.converter.queue.append(filename)
+    print 'recover method %s' % filename
+
+  def backlogHeld(self):
+    """
+    the background convert of the backlog has to wait while recording,
+    converting or when an event is near
+    """
+    return (self._recording_.isSet() or self._converting_.isSet() or
+            self.recorder.prerolling() or
+            self.scheduler.isNear(BACKLOG_HOLD_SECONDS))
+
+  def preroll(self):
+    """
+    Called ahead of a scheduled event to open the input and arm it
+    to start recording at the start of the event, keeping the audio
+    from just before
+    """
+    self.scheduler._event_.set()
+    recordSeconds = self.scheduler.getDuration()
+    self.recorder.setRecordSeconds(recordSeconds)
+    self.recorder.expectedBytes = self.scheduler.getExpectedSizes(recordSeconds)
+    # name the file for the start of the event, not for now
+    self.recorder.setFilename(time.strftime(WAVE_FILENAME_FORMAT,
+                              time.localtime(self.scheduler.getStart())))
+    self.recorder.prerollRecording(PREROLL_SECONDS,self.scheduler.getStart())
+    print 'preroll method'
 
   def updateSchedule(self):
     """
@@ -441,6 +652,8 @@ class Recorder(threading.Thread):
     #self._startRecording_ = threading.Event()
     # recording in process
     self._recording_ = threading.Event()
+    # input open and keeping audio for the next recording
+    self._prerolling_ = threading.Event()
     ## pause recording
     #self._pauseRecording_ = threading.Event()
     ## stop recording
@@ -449,6 +662,20 @@ class Recorder(threading.Thread):
     self.record = None
     self.waveFilename = 'test.wav'
     self.recordSeconds = 20
+    self.segmentSeconds = SEGMENT_SECONDS
+    self.segmentBytes = SEGMENT_BYTES
+    # called as fn(filename,number,last) when a segment is closed
+    self.segmentListeners = []
+    self.encodeFormat = STREAM_ENCODE_FORMAT
+    self.keepWave = STREAM_ENCODE_KEEP_WAVE
+    # the compressed file from the last recording if it was encoded
+    self.encodedFile = None
+    # the segment files of the last recording if it was segmented
+    self.segments = []
+    # sizes to preallocate for the wave file of each device
+    self.expectedBytes = 0
+    # clipped samples in the last recording if they were metered
+    self.clip = None
   
   def clearAll(self,but=None):
     for a in self.__dict__:
@@ -481,10 +708,11 @@ class Recorder(threading.Thread):
     return the current recording filename, or set a new one
     """
     if name:
-      if self.recroding(): raise sR.RecordingError, 'Can not set new filename'
+      if self.recording() or self.prerolling():
+        raise sR.RecordingError, 'Can not set new filename'
       else: self.waveFilename  = name[0]
     else:
-      if not self.recording(): 
+      if not self.recording() and not self.prerolling():
         self.waveFilename = time.strftime(WAVE_FILENAME_FORMAT,
                                           time.localtime())
     return self.waveFilename
@@ -502,14 +730,52 @@ class Recorder(threading.Thread):
     """
     return the time left in the recording
     """
-    return self.record.timeLeft
-    
+    return self.record.timeLeft()
+
+  def levels(self):
+    """
+    return the latest levels of the current recording
+    """
+    if self.record: return self.record.levels()
+    else: return {}
+
+  def dspSettings(self):
+    """
+    return the DSP stages applied to the current recording
+    """
+    if self.record: return self.record.dspSettings()
+    else: return []
+
+  def callbackStats(self):
+    """
+    return the callback timing and error stats of the current recording
+    """
+    if self.record: return self.record.callbackStats()
+    else: return {}
+
+  def bufferStats(self):
+    """
+    return the ring buffer and writer stats of the current recording
+    """
+    if self.record: return self.record.bufferStats()
+    else: return {}
+
+  def subscribeSegments(self,fn):
+    """
+    have fn(filename,number,last) called each time a segment of a
+    segmented recording is closed
+    """
+    self.segmentListeners.append(fn)
+
   def recording(self):
     return self._recording_.isSet()
 
+  def prerolling(self):
+    return self._prerolling_.isSet()
+
   def recordStreamActive(self):
     if self.record and self.recording():
-      return self.record.stream.is_active()
+      return self.record.active()
     elif not self.record:
       raise sR.RecordingError, 'no active recording instance, thus no active stream'
     else:
@@ -519,12 +785,58 @@ class Recorder(threading.Thread):
   def startRecording(self):
     """
     create and start a new Record instance with the current settings
+    or start the prerolling one
     """
-    self.record = sR.Record(recordSeconds = self.recordSeconds,
-                            waveFilename = self.waveFilename)
+    if not self.prerolling(): self.newRecord()
+    self._prerolling_.clear()
     self.record.start()
     self._recording_.set()
 
+  def prerollRecording(self,seconds,startTime=None):
+    """
+    create a new Record instance with the current settings and start
+    keeping the last seconds of input ahead of startRecording(),
+    with a startTime the recording starts on that frame, whenever
+    startRecording() is called before
+    """
+    if self.recording() or self.prerolling():
+      raise sR.RecordingError, 'can not preroll; already recording'
+    self.newRecord()
+    if startTime: self.record.arm(startTime,seconds)
+    else: self.record.preroll(seconds)
+    self._prerolling_.set()
+
+  def cancelPreroll(self):
+    """
+    close the prerolling Record instance without recording anything
+    """
+    if self.prerolling():
+      self._prerolling_.clear()
+      self.record.stop()
+      del self.record
+      self.record = None
+
+  def newRecord(self):
+    """
+    create a new Record instance with the current settings
+    """
+    self.encodedFile = None
+    encodeFilename = None
+    if self.encodeFormat:
+      encodeFilename = "%s.%s" % (os.path.splitext(self.waveFilename)[0],
+                                  self.encodeFormat)
+    self.record = sR.Session(devices = INPUT_DEVICES,
+                             splitChannels = SPLIT_CHANNELS,
+                             recordSeconds = self.recordSeconds,
+                             waveFilename = self.waveFilename,
+                             segmentSeconds = self.segmentSeconds,
+                             segmentBytes = self.segmentBytes,
+                             encodeFilename = encodeFilename,
+                             keepWave = self.keepWave or not encodeFilename,
+                             expectedBytes = self.expectedBytes)
+    if self.record.segmented:
+      for fn in self.segmentListeners: self.record.subscribe(fn)
+
   def pauseRecording(self):
     """
     pause the current recording, this just stops the wave file output
@@ -546,6 +858,14 @@ class Recorder(threading.Thread):
       filename = self.setFilename()
       # stop recording
       self.record.stop()
+      self.encodedFile = self.record.encodedFile()
+      self.clip = self.record.levels().get('clipTotal')
+      # earlier segments have already been handed off,
+      # return the last one for the normal convert and upload
+      self.segments = []
+      if self.record.segmented and self.record.wf.segments:
+        self.segments = list(self.record.wf.segments)
+        filename = self.segments[-1]
       # delete and reset the instance
       del self.record
       self.record = None
@@ -579,6 +899,10 @@ class Scheduler(threading.Thread):
     # this is created as the start because
     # it needs to store an event
     self.schedule = sS.Schedule()
+    # recovered recordings to look up on the calendar, and what was
+    # found for them as (filename,event or None) for the Controller
+    self.lookups = []
+    self.found = []
   
   def start(self):
     # do an update on startup
@@ -614,6 +938,7 @@ class Scheduler(threading.Thread):
       elif self._event_.isSet(): pass
       elif self._update_.isSet(): self.updateEvent()
       elif self._purge_.isSet(): self.purgeOld()
+      elif self.lookups: self.lookUp()
       elif time.strftime('%H:%M',time.localtime()) == DAILY_UPDATE_TIME:
         startTime = time.time()
         self.purgeOld()
@@ -635,13 +960,43 @@ class Scheduler(threading.Thread):
     """
     return os.statvfs('.').f_bsize*os.statvfs('.').f_bavail
 
-  def getExpectedFilesize(self):
+  def lookUp(self):
+    """
+    find the calendar event of the next recording in lookups, with a
+    Schedule of its own so the current event is left alone, a recording
+    which can not be looked up (as when offline) is passed on without one
+    """
+    filename = self.lookups.pop(0)
+    lookupSchedule = sS.Schedule()
+    event = None
+    try:
+      lookupSchedule.connect()
+      event = lookupSchedule.getBy('filename',filename)
+    except (IOError,sS.httplib2.HttpLib2Error,sS.HttpError),e:
+      if DEBUG: print "could not look up %s: %s" % (filename,e)
+    if event and event['id'] is None: event = None
+    self.found.append((filename,event))
+    del lookupSchedule
+
+  def getExpectedSizes(self,seconds=0):
+    """
+    expected size in bytes of the recording of each of INPUT_DEVICES,
+    for the next scheduled recording or for seconds if given
+    """
+    if seconds <= 0: seconds = self.getDuration()
+    if seconds <= 0: seconds = RECORD_SECONDS_DEFAULT
+    return sR.expectedSizes(INPUT_DEVICES,seconds)
+
+  def getExpectedFilesize(self,seconds=0):
     """
-    expected size of next scheduled recording in bytes
+    expected size of next scheduled recording in bytes over all of the
+    devices, or of a recording of seconds if given
     """
-    size = sR.SAMPLE_SIZE*sR.INPUT_CHANNELS*sR.SAMPLING_RATE
-    if self.getDuration() > 0: size *= self.getDuration()
-    else: size *= RECORD_SECONDS_DEFAULT
+    sizes = self.getExpectedSizes(seconds)
+    size = sum(sizes)
+    # a split primary is written whole as well
+    primaryChannels = INPUT_DEVICES and INPUT_DEVICES[0][1] or sR.Record.inputChannels
+    if SPLIT_CHANNELS and primaryChannels > 1: size += sizes[0]
     return size
 
   def updateEvent(self):
@@ -667,6 +1022,14 @@ class Scheduler(threading.Thread):
      return True
     else: return False
 
+  def isUnderway(self):
+    """
+    true from the start of the event to its end
+    """
+    start = self.schedule.event['start']
+    duration = self.schedule.event['duration']
+    return duration > 0 and start <= time.time() < start + duration
+
   def updateItems(self,**status):
     """
       update items in the current events status
@@ -699,8 +1062,10 @@ class Scheduler(threading.Thread):
     purge old recordings
     """
     self._purge_.clear()
-    # get all files recorded and converted  by STELC_pi
-    purgeList = filter(lambda x:re.search(PURGE_RE,x),os.listdir('.'))
+    # get all files recorded and converted  by STELC_pi, but not the
+    # sidecars which go along with their recording
+    purgeList = filter(lambda x:re.search(PURGE_RE,x) and not sR.isSidecar(x),
+                       os.listdir('.'))
     # sort based on modification times
     purgeList.sort(cmp=lambda x,y: cmp(os.stat(x).st_mtime,os.stat(y).st_mtime))
     if DEBUG: print purgeList
@@ -712,9 +1077,13 @@ class Scheduler(threading.Thread):
     while purgeList:
       if self.getExpectedFilesize()*SPACE_ALLOWANCE_FACTOR > self.getAvailableSpace():
         fileToPurge = purgeList.pop()
-        # remove the file
+        # remove the file, and with a recording what was written about it
         if DEBUG: print "removing %s" % fileToPurge
         os.remove(fileToPurge)
+        if fileToPurge.endswith('.wav'):
+          for sidecar in sR.sidecars(fileToPurge):
+            if DEBUG: print "removing %s" % sidecar
+            os.remove(sidecar)
         # find any events that match this file
         purgeSchedule.connect()
         purgeSchedule.getBy('filename',fileToPurge)
@@ -748,11 +1117,29 @@ class Converter(threading.Thread):
     # currently converting
     self._converting_ = threading.Event()
     self.convert = None
-    self.convertFormat = 'mp3'
+    self.convertFormats = CONVERT_FORMATS
+    self.convertFormat = self.convertFormats[0]
     self.convertFile = ''
+    self.convertTrim = True
     self.convertedFile = ''
     self.progress = '0%'
     self.clip = 0
+    # progress of the current convert as a dictionary (see sV.Convert)
+    self.status = {}
+    # closed recording segments waiting for a background convert
+    self.queue = []
+    self.queuedConvert = None
+    # converted segments are appended here for upload (the Uploader's queue)
+    self.uploadQueue = None
+    # what has been converted before
+    self.cache = sH.Cache()
+    # wav files still to be converted, oldest first, and those that failed
+    self.backlog = []
+    self.backlogFailed = []
+    self.backlogConvert = None
+    self.backlogHeld = time.time()
+    self.backlogScanned = 0
+    self.loadBacklog()
   
   def clearAll(self,but=None):
     for a in self.__dict__:
@@ -781,6 +1168,9 @@ class Converter(threading.Thread):
       elif self._converting_.isSet():
         self.progress = self.convert.progress
         self.clip = self.convert.clip
+        self.status = self.convert.status
+      elif self.queue: self.convertQueued()
+      elif self.backlogReady(): self.convertBacklog()
       time.sleep(LOOP_DELAY)
 
   def startConvert(self):
@@ -788,11 +1178,212 @@ class Converter(threading.Thread):
     self.convert = sV.Convert()
     # clear this flag after the Convert object has been created
     self._startConvert_.clear()
-    self.convertedFile = self.convert.convert(self.convertFile,self.convertFormat)
+    keep = None
+    if self.convertTrim: keep = self.keepRegions(self.convertFile)
+    elif DEBUG: print "not trimming silence from %s" % self.convertFile
+    try:
+      self.convertedFile = self.cachedConvert(self.convert,self.convertFile,keep)
+    except (sV.ConvertError,IOError,OSError),e:
+      # better to upload the wav than nothing at all, if it is there
+      if not self.convert.cancelled: self.fail = str(e)
+      if DEBUG: print "convert failed: %s" % e
+      self.convertedFile = os.path.exists(self.convertFile) and self.convertFile or ''
+    self.clip = self.convert.clip
+    self.status = self.convert.status
     del self.convert
     self.convert = None
     self._converting_.clear()
 
+  def convertSettings(self,filename,keep):
+    """
+    what a convert depends on besides the audio, for the cache
+    """
+    # the converted files are named after the source
+    return {'source': os.path.abspath(filename),
+            'formats': self.convertFormats,
+            'options': [sV.FORMAT_OPTIONS.get(fmt,'') for fmt in self.convertFormats],
+            'encoder': sV.ENCODER,
+            'chunkEncoder': sV.CHUNK_ENCODER,
+            'chunkBitrate': sV.CHUNK_BITRATE,
+            'keep': keep}
+
+  def cachedConvert(self,convert,filename,keep=None):
+    """
+    convert filename with convert unless it has been converted the same
+    way before and the output is still there, return the converted file
+    """
+    key = self.cache.key(filename,self.convertSettings(filename,keep))
+    convertedFile = key and self.cache.converted(key)
+    if convertedFile:
+      if DEBUG: print "%s already converted to %s" % (filename,convertedFile)
+      convert.progress = '100%'
+      return convertedFile
+    convertedFile = convert.convert(filename,self.convertFormats,keep)
+    if key: self.cache.putConverted(key,convertedFile,convert.convertedFiles.values())
+    return convertedFile
+
+  def cancelConvert(self):
+    """
+    end the convert in progress, called from the Controller
+    """
+    convert = self.convert
+    if convert: convert.cancel()
+
+  def keepRegions(self,filename):
+    """
+    return the [start,end] frame regions of filename to convert based
+    on its silence sidecar, or None to convert all of it
+    """
+    if not TRIM_SILENCE: return None
+    silence = sR.readSilence(filename)
+    if not silence: return None
+    if SKIP_SILENCE: keep = silence['keep']
+    else: keep = [silence['trim']]
+    # nothing to do if that is the whole recording
+    if keep == [[0,silence['frames']]]: return None
+    return keep
+
+  def convertQueued(self):
+    """
+    convert the next closed recording segment in the background
+    and pass it on for upload
+    """
+    filename = self.queue.pop(0)
+    if DEBUG: print "convert queued segment: %s" % filename
+    convert = sV.Convert()
+    self.queuedConvert = convert
+    cancelled = False
+    try:
+      # the Controller asked for a convert while this was being set up
+      if self._startConvert_.isSet(): convert.cancel()
+      convertedFile = self.cachedConvert(convert,filename)
+    except (sV.ConvertError,IOError,OSError),e:
+      if DEBUG: print "convert failed: %s" % e
+      convertedFile = filename
+      cancelled = convert.cancelled
+    self.queuedConvert = None
+    if cancelled:
+      # done again after the Controller's convert
+      self.queue.insert(0,filename)
+      return
+    if self.uploadQueue is not None: self.uploadQueue.append(convertedFile)
+
+  def loadBacklog(self):
+    """
+    read the backlog kept from before a restart
+    """
+    if not os.path.exists(BACKLOG_FILENAME): return
+    try:
+      f = open(BACKLOG_FILENAME)
+      backlog = yaml.safe_load(f) or {}
+      f.close()
+    except (IOError,yaml.YAMLError),e:
+      if DEBUG: print "could not read %s: %s" % (BACKLOG_FILENAME,e)
+      return
+    self.backlog = backlog.get('queue') or []
+    self.backlogFailed = backlog.get('failed') or []
+
+  def saveBacklog(self):
+    tmpFilename = BACKLOG_FILENAME + '.tmp'
+    f = open(tmpFilename,'w')
+    yaml.safe_dump({'queue': self.backlog,'failed': self.backlogFailed},
+                   f,default_flow_style=False)
+    f.close()
+    os.rename(tmpFilename,BACKLOG_FILENAME)
+
+  def needsConvert(self,filename):
+    """
+    True for a finished recording which has not been converted
+    """
+    return (os.path.exists(filename) and
+            not os.path.exists(os.path.splitext(filename)[0] + '.' +
+                               self.convertFormat) and
+            # still being written or waiting to be recovered
+            not os.path.exists(sR.journalSidecar(filename)) and
+            filename != self.convertFile and filename not in self.queue)
+
+  def scanBacklog(self):
+    """
+    add the wav files without a converted file next to them to the
+    backlog and sort it oldest first
+    """
+    self.backlogScanned = time.time()
+    found = [fn for fn in os.listdir('.')
+             if re.search(PURGE_RE,fn) and fn.endswith('.wav') and
+             not re.search(RECOVER_SKIP_RE,fn)]
+    backlog = [fn for fn in set(self.backlog + found)
+               if fn not in self.backlogFailed and self.needsConvert(fn)]
+    backlog.sort(key=lambda fn: os.stat(fn).st_mtime)
+    if backlog != self.backlog:
+      self.backlog = backlog
+      if DEBUG: print "convert backlog: %s" % self.backlog
+      self.saveBacklog()
+
+  def preempt(self):
+    """
+    make way for a convert from the Controller, a queued or backlog
+    convert in progress is cancelled and done again later
+    """
+    self.holdBacklog()
+    convert = self.queuedConvert
+    if convert and not convert.cancelled:
+      if DEBUG: print "queued convert cancelled"
+      convert.cancel()
+
+  def holdBacklog(self):
+    """
+    keep the backlog waiting and cancel a backlog convert in progress,
+    called from the Controller
+    """
+    self.backlogHeld = time.time()
+    convert = self.backlogConvert
+    if convert and not convert.cancelled:
+      if DEBUG: print "backlog convert cancelled"
+      convert.cancel()
+
+  def backlogReady(self):
+    """
+    True when the next file in the backlog can be converted
+    """
+    # give the Controller time to hold it again
+    if time.time() - self.backlogHeld < 10.*LOOP_DELAY: return False
+    if time.time() - self.backlogScanned > BACKLOG_SCAN_SECONDS:
+      self.scanBacklog()
+    return len(self.backlog) > 0
+
+  def convertBacklog(self):
+    """
+    convert the oldest recording in the backlog at low priority
+    and pass it on for upload, unless it was cancelled
+    """
+    filename = self.backlog[0]
+    if not self.needsConvert(filename):
+      self.backlog.pop(0)
+      self.saveBacklog()
+      return
+    if DEBUG: print "convert backlog: %s" % filename
+    convert = sV.Convert()
+    convert.nice = BACKLOG_NICE
+    self.backlogConvert = convert
+    # held again while it was being set up
+    if time.time() - self.backlogHeld < 10.*LOOP_DELAY:
+      self.backlogConvert = None
+      return
+    try:
+      convertedFile = convert.convert(filename,self.convertFormats,
+                                      self.keepRegions(filename))
+    except (sV.ConvertError,IOError,OSError),e:
+      convertedFile = None
+      if DEBUG: print "convert failed: %s" % e
+    self.backlogConvert = None
+    # a cancelled convert is tried again once the backlog is let go
+    if convert.cancelled: return
+    self.backlog.remove(filename)
+    if convertedFile is None: self.backlogFailed.append(filename)
+    self.saveBacklog()
+    if convertedFile and self.uploadQueue is not None:
+      self.uploadQueue.append(convertedFile)
+
 
 class Uploader(threading.Thread):
   def __init__(self):
@@ -814,6 +1405,12 @@ class Uploader(threading.Thread):
     self.upload = None
     self.uploadFile = ''
     self.progress = '0%'
+    # converted segments waiting for a background upload
+    self.queue = []
+    self.queuedUpload = None
+    # what has been uploaded before and the ID of the last upload
+    self.cache = sH.Cache()
+    self.remoteId = None
   
   def clearAll(self,but=None):
     for a in self.__dict__:
@@ -841,6 +1438,7 @@ class Uploader(threading.Thread):
         self.startUpload()
       elif self._uploading_.isSet():
         self.progress = self.upload.progress
+      elif self.queue: self.uploadQueued()
       time.sleep(LOOP_DELAY)
 
   def startUpload(self):
@@ -848,11 +1446,65 @@ class Uploader(threading.Thread):
     self.upload = sU.Upload()
     # clear this flag after the Upload object has been created
     self._startUpload_.clear()
-    self.upload.upload(self.uploadFile)
+    self.remoteId = self.cachedUpload(self.upload,self.uploadFile)
     del self.upload
     self.upload = None
     self._uploading_.clear()
 
+  def cachedUpload(self,upload,filename):
+    """
+    upload filename with upload unless the same file has been uploaded
+    before, return the remote file ID or None if the upload failed
+    """
+    key = self.cache.key(filename,{'uploader': sU.__name__,
+                                   'name': os.path.basename(filename)})
+    remoteId = key and self.cache.uploaded(key)
+    if remoteId:
+      if DEBUG: print "%s already uploaded as %s" % (filename,remoteId)
+      upload.progress = '100%'
+      return remoteId
+    result = upload.upload(filename)
+    if not result: return None
+    # Google Drive gives the new file's metadata, Dropbox just succeeds
+    if isinstance(result,dict): remoteId = result['id']
+    else: remoteId = upload.remoteFile
+    if key: self.cache.putUploaded(key,filename,remoteId)
+    return remoteId
+
+  def cancelUpload(self):
+    """
+    end the upload in progress, called from the Controller
+    """
+    upload = self.upload
+    if upload: upload.cancel()
+
+  def uploadQueued(self):
+    """
+    upload the next converted segment in the background
+    """
+    filename = self.queue.pop(0)
+    if DEBUG: print "upload queued segment: %s" % filename
+    upload = sU.Upload()
+    self.queuedUpload = upload
+    # the Controller asked for an upload while this was being set up
+    if self._startUpload_.isSet(): upload.cancel()
+    remoteId = self.cachedUpload(upload,filename)
+    self.queuedUpload = None
+    if remoteId is None and upload.cancelled:
+      # done again after the Controller's upload
+      self.queue.insert(0,filename)
+    del upload
+
+  def preempt(self):
+    """
+    make way for an upload from the Controller, a queued upload in
+    progress is cancelled and done again later
+    """
+    upload = self.queuedUpload
+    if upload and not upload.cancelled:
+      if DEBUG: print "queued upload cancelled"
+      upload.cancel()
+
 
 class Copier(threading.Thread):
   def __init__(self):
@@ -911,9 +1563,20 @@ class Copier(threading.Thread):
     del self.copy
     self.copy = None
     self._copying_.clear()
+
+  def cancelCopy(self):
+    """
+    end the copy in progress, called from the Controller
+    """
+    copy = self.copy
+    if copy: copy.cancel()
       
 
 if __name__ == '__main__':
+  # STELC_pi.py calibrate finds the best chunk size for the input device
+  if 'calibrate' in sys.argv[1:]:
+    sR.calibrate()
+    sys.exit()
   r = Recorder()
   s = Scheduler()
   v = Converter()